@@ -4,7 +4,6 @@ Created on Mar 5, 2015
 '''
 
 import numpy as np
-import matplotlib.pyplot as plt
 
 from analysis import torus_distance
 from mle_analysis import MLE_analyse
@@ -149,35 +148,42 @@ class IBD_Detector(object):
         self.info_mat[indices[0], indices[1], 0] = coal_mat[indices]  # New coalescence time 
         self.info_mat[indices[0], indices[1], 1] = locus  # New start locus
         
-    def detect_inbreeding(self, loop_time):
+    def detect_inbreeding(self, loop_time, treshold_len, show=False):
         '''Detect shared long blocks between neighboring individuals, prints fraction of genome that shows short loops.
-        Also prints ROH stats. Start list has to consist of neighbours!'''
-        treshold_len = input("ROH-treshold length (in loci): ")
-        roh_blocks = []
-        # Generate list of coalescence times with next individual in start list at all loci
-        t_list = np.array([self.get_mrca_t(ind, ind + 1, locus) for locus in range(0, len(self.tau)) for ind in range(1, len(self.tau[0]) / 2, 2)])
-        print("Got t_list...")
-        t_mat = np.reshape(t_list, (len(self.tau), len(self.tau[0]) / 4))  # Locus x Individual List
-        block_starts = np.zeros(len(self.tau[0]) / 4)
-        
-        for i in range(1, len(self.tau)):  # Iterate over all loci
-            jumps = t_mat[i, :] != t_mat[i - 1, :]  # Detect all jumps
-            indices = np.nonzero(jumps)  # Extract indices where jump
-            
-            longjumps = jumps & (block_starts <= (i - treshold_len)) & (t_mat[i - 1, :] < 10000)  # Detect all long jumps (with finite coal. time)
-            indices_longjumps = np.nonzero(longjumps)  # Extract their indices
-            roh_blocks += list(i - block_starts[indices_longjumps])
-            block_starts[indices] = i
+        Also prints ROH stats. Start list has to consist of neighbours!
+        Return array of ROH-lengths (in loci) and array of inbreeding fraction per pair'''
+        # Coalescence times with next individual in start list at all loci
+        inds = np.arange(1, len(self.tau[0]) / 2, 2)
+        t_mat = self.get_mrca_t_mat(inds, inds + 1)  # Locus x Pair Matrix
+        print("Got t_mat...")
+        
+        # Find all jumps; ordered by pair and then by locus
+        pair_ind, locus_ind = np.nonzero((t_mat[1:, :] != t_mat[:-1, :]).T)
+        locus_ind = locus_ind + 1  # Locus where new block starts
+        
+        # Start of every block: Previous jump of the same pair, or 0
+        block_starts = np.zeros(len(locus_ind))
+        same_pair = pair_ind[1:] == pair_ind[:-1]
+        block_starts[1:][same_pair] = locus_ind[:-1][same_pair]
+        
+        roh_lengths = locus_ind - block_starts
+        long_roh = (roh_lengths >= treshold_len) & (t_mat[locus_ind - 1, pair_ind] < 10000)  # Long blocks with finite coal. time
+        roh_blocks = roh_lengths[long_roh]
         
         print("Detected ROH blocks above %.2f consecutive loci: %.1f" % (treshold_len, len(roh_blocks)))  
-        frac_ROH = sum(roh_blocks) / (len(self.tau) * len(self.tau[0]) / 4.0)
+        frac_ROH = np.sum(roh_blocks) / float(t_mat.size)
         print("Genomic fraction of detected long ROH runs: % .4f" % frac_ROH)
         
-        recent_ancestry = (t_list < loop_time)
-        inbred_fraction = np.sum(recent_ancestry) / float(len(t_list))
-        print("Inbreeding fraction: %.4f:" % inbred_fraction)
+        inbred_fractions = np.mean(t_mat < loop_time, axis=0)  # Fraction of recent ancestry per pair
+        print("Inbreeding fraction: %.4f:" % np.mean(inbred_fractions))
         
-        # Plot CDF
+        if show == True:
+            self.plot_inbreeding(t_mat.flatten(), roh_blocks)
+        return roh_blocks, inbred_fractions
+    
+    def plot_inbreeding(self, t_list, roh_blocks):
+        '''Plot CDF of coalescence times and histogram of ROH-blocks'''
+        import matplotlib.pyplot as plt
         plt.figure()
         counts, bin_edges = np.histogram(t_list, bins=1000, range=[0, 200])
         cdf = np.cumsum(counts)
@@ -192,6 +198,29 @@ class IBD_Detector(object):
         plt.xlabel('Block Length')
         plt.ylabel('ROH-blocks')
         plt.show()
+    
+    def get_mrca_t_mat(self, inds1, inds2):
+        '''Calculates time of most recent common ancestor between all pairs
+        of inds1 and inds2 at all loci at once. Return Locus x Pair Matrix'''
+        pi = np.asarray(self.pi)
+        loci = np.arange(len(pi))[:, None]  # For indexing every locus
+        anc1 = pi[:, inds1]  # Get ancestors
+        anc2 = pi[:, inds2]
+        
+        ancient = (anc1 == 0) | (anc2 == 0)  # No product: pi can be small unsigned integers
+        active = (anc1 != anc2) & ~ancient
+        while np.any(active):
+            # Update the younger locus
+            up2 = active & (anc1 > anc2)
+            up1 = active & (anc1 < anc2)
+            anc2 = np.where(up2, pi[loci, anc2], anc2)
+            anc1 = np.where(up1, pi[loci, anc1], anc1)
+            ancient = (anc1 == 0) | (anc2 == 0)
+            active = (anc1 != anc2) & ~ancient
+        
+        t_mat = np.asarray(self.tau)[loci, anc1].astype(float)
+        t_mat[ancient] = 100000  # In case ancient coalescence
+        return t_mat
         
     def get_mrca_t(self, ind1, ind2, locus):
         '''Calculates time of most recent common ancestor between inds at locus i'''
@@ -199,20 +228,30 @@ class IBD_Detector(object):
         anc2 = self.pi[locus][ind2]  # Get ancestor
         
         while True:
-            if anc1 == anc2 or anc1 * anc2 == 0: break 
+            if anc1 == anc2 or anc1 == 0 or anc2 == 0: break 
             # Update the younger locus
             if anc1 > anc2:
                 anc2 = self.pi[locus][anc2]
             elif anc1 < anc2:
                 anc1 = self.pi[locus][anc1]
         
-        if anc1 * anc2 == 0: return 100000  # In case ancient coalescence
+        if anc1 == 0 or anc2 == 0: return 100000  # In case ancient coalescence
         else: return self.tau[locus][anc1]
                          
     def delete_history(self):
         '''Deletes PI and TAU, not needed for IBD mle_analysis'''
         self.pi = []
         self.tau = []
+
+    def redetect(self, IBD_treshold=0, t_ancestral=0, effective=False):
+        '''Re-run IBD-detection on the existing history with new parameters.
+        If a parameter is 0 keep the old value. Return the IBD-blocks'''
+        if IBD_treshold: self.IBD_treshold = IBD_treshold
+        if t_ancestral: self.t_ancestral = t_ancestral
+
+        if effective == True: self.IBD_detection_eff()
+        else: self.IBD_detection()
+        return self.IBD_blocks
         
         
 #############################################################################
@@ -0,0 +1,84 @@
+'''
+Created on Oct 19, 2026
+Class to save the genealogies produced by DISCSIM (pi and tau) on disk,
+so that IBD-detection can be redone with other parameters without simulating again.
+'''
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+
+class History_Cache(object):
+    '''Saves and loads DISCSIM histories. Every history is keyed by
+    the simulation parameters and the random seed of the run.
+    Uncompressed histories are saved as .npy files that can be memory-mapped;
+    compressed ones are smaller but have to be loaded completely.'''
+    folder = "history_cache/"  # Folder where the histories are saved
+    compress = False  # Whether to save compressed (not memory-mappable)
+
+    def __init__(self, folder="history_cache/", compress=False):
+        self.folder = folder
+        self.compress = compress
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def get_key(self, params, seed):
+        '''Returns key for dictionary of simulation parameters and seed'''
+        key_string = json.dumps(params, sort_keys=True) + " seed: %i" % seed
+        return hashlib.md5(key_string.encode("utf-8")).hexdigest()
+
+    def get_path(self, params, seed):
+        '''Return the folder in which the history is saved'''
+        return os.path.join(self.folder, self.get_key(params, seed))
+
+    def contains(self, params, seed):
+        '''Whether history for these parameters and seed is saved'''
+        return os.path.exists(self.get_path(params, seed))
+
+    def save(self, pi, tau, params, seed):
+        '''Save pi and tau (as given by sim.get_history()).
+        Tau has to be in model time. Writes to temporary folder first;
+        so that an interrupted save never leaves a broken history'''
+        path = self.get_path(params, seed)
+        temp_path = path + ".tmp"
+        if os.path.exists(temp_path):
+            shutil.rmtree(temp_path)
+        os.makedirs(temp_path)
+
+        pi = np.asarray(pi)
+        pi = pi.astype(np.min_scalar_type(np.max(pi)))  # Use smallest integer type fitting all nodes
+        tau = np.asarray(tau, dtype=float)
+
+        if self.compress == True:
+            np.savez_compressed(os.path.join(temp_path, "history.npz"), pi=pi, tau=tau)
+        else:
+            np.save(os.path.join(temp_path, "pi.npy"), pi)
+            np.save(os.path.join(temp_path, "tau.npy"), tau)
+
+        with open(os.path.join(temp_path, "params.json"), "w") as f:
+            json.dump({"params": params, "seed": seed}, f, sort_keys=True)
+
+        if os.path.exists(path):  # Replace existing history
+            shutil.rmtree(path)
+        os.rename(temp_path, path)
+        print("History saved to: %s" % path)
+
+    def load(self, params, seed, mmap_mode="c"):
+        '''Load pi and tau (tau in model time) as arrays Loci x Nodes.
+        mmap_mode as in np.load; default is copy on write,
+        so tau can be converted in place without changing the file'''
+        path = self.get_path(params, seed)
+        if not os.path.exists(path):
+            raise IOError("No history saved for seed %i at %s" % (seed, path))
+
+        if os.path.exists(os.path.join(path, "history.npz")):  # Compressed history
+            history = np.load(os.path.join(path, "history.npz"))
+            pi, tau = history["pi"], history["tau"]
+        else:
+            pi = np.load(os.path.join(path, "pi.npy"), mmap_mode=mmap_mode)
+            tau = np.load(os.path.join(path, "tau.npy"), mmap_mode=mmap_mode)
+        print("History loaded: Loci: %i Nodes per locus: %i" % (len(tau), len(tau[0])))
+        return pi, tau
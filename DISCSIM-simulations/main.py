@@ -56,7 +56,7 @@ def main():
             print("Transformation factor: 1 Time unit is %.3f generations:" % trans.to_gen_time(1.0))
             
             pi, tau = sim.get_history()  # Extract the necessary data
-            tau = trans.to_gen_time(np.array(tau))  # Vectorize and measure time in Gen time.
+            pi, tau = trans.convert_history(pi, tau)  # Vectorize and measure time in Gen time.
             
         elif inp == 2:  
             chrom_l = num_loci * recombination_rate * 100
@@ -66,7 +66,7 @@ def main():
             if inp1 == 1:   det.IBD_detection()  
             elif inp1 == 2: det.IBD_detection_eff()               
             elif inp1 == 3: 
-                det.detect_inbreeding(input("Loop time: "))
+                det.detect_inbreeding(input("Loop time: "), input("ROH-treshold length (in loci): "), show=True)
                   
             print("Number of IBD-blocks detected %.2f" % len(det.IBD_blocks))
             
@@ -8,13 +8,13 @@ from analysis import Analysis
 from math import sqrt
 import cPickle as pickle
 import numpy as np
-import matplotlib.pyplot as plt
 import discsim
 import ercs
 from units import Unit_Transformer
 from timeit import default_timer as timer
 from IBD_detection import IBD_Detector
-from random import shuffle
+from history_cache import History_Cache
+from random import Random
 from scipy.special import kv as kv  # Import Bessel functions of second kind
 
 nr_runs = 10  # How many runs
@@ -32,10 +32,32 @@ num_loci = 1500  # Total number of loci
 time = 1000  # Generation time for a single run
 startlist = []
 IBD_treshold = 40  # Nr of loci considered IBD
+progress_interval = 100  # After how many generations progress is reported (0: never)
+cache_folder = "history_cache/"  # Where DISCSIM histories are saved
 
 
-def single_run(run_i, u=u, nb=False):
-    ''' Do a single run, parameters are saved in grid'''
+def advance(sim, trans, gen_time, progress=None, interval=0):
+    '''Run the DISCSIM simulator until gen_time (in generations). Does this in one call;
+    if progress function and interval (in generations) given, call progress(generation)
+    every interval generations.'''
+    end_time = trans.to_model_time(gen_time)  # Model time to run to
+    if progress == None or interval <= 0:
+        sim.run(until=end_time)
+        return
+    
+    for t in np.arange(interval, gen_time, interval):
+        sim.run(until=trans.to_model_time(t))
+        progress(t)
+    sim.run(until=end_time)
+    progress(gen_time)
+
+def print_progress(gen_time):
+    '''Progress function for advance'''
+    print("Simulated generations: %.0f" % gen_time)
+
+def single_run(run_i, u=u, nb=False, seed=None):
+    ''' Do a single run, parameters are saved in grid.
+    If seed is given use it as seed for DISCSIM'''
     trans = Unit_Transformer(grid_size, u, r)
     sim = discsim.Simulator(grid_size)  # Create new Discsim-Simulator
     startlist = [(i, j) for i in range(0, grid_size, sample_steps) for j in range(0, grid_size, sample_steps)]
@@ -45,12 +67,12 @@ def single_run(run_i, u=u, nb=False):
     sim.recombination_probability = recombination_rate
     sim.num_loci = num_loci
     sim.max_population_size = 100000
+    if seed != None:
+        sim.random_seed = seed
     
     # Do the run.
     start = timer()
-    for i in range(1, int(np.ceil(trans.to_model_time(time)))):  # Update to generation time!
-        print("Simulation %.0f Doing step: %.0f u: %.3f" % (run_i, i, u))
-        sim.run(until=(i))
+    advance(sim, trans, time, progress=print_progress, interval=progress_interval)
     end = timer()
             
     print("\nRun time: %.2f s" % (end - start))
@@ -59,7 +81,7 @@ def single_run(run_i, u=u, nb=False):
     
     # Extract pedigrees and do Block detection            
     pi, tau = sim.get_history()  # Extract the necessary data
-    tau = trans.to_gen_time(np.array(tau))  # Vectorize and measure time in Gen time.
+    pi, tau = trans.convert_history(pi, tau)  # Vectorize and measure time in Gen time.
     chrom_l = num_loci * recombination_rate * 100
     det = IBD_Detector(tau, pi, recombination_rate, grid_size, startlist, IBD_treshold, time, chrom_l)  # Turn on a IBD_Detector
 
@@ -68,7 +90,7 @@ def single_run(run_i, u=u, nb=False):
     if nb == False:
         # Do classic IBD-Detection
         det.IBD_detection()
-        block_nr = len(det.IBD_list)
+        block_nr = len(det.IBD_blocks)
         print("Number of IBD-blocks detected %.2f" % block_nr)
     
         data = Analysis(det)  # Do Data-Analysis and extract sigma!
@@ -112,8 +134,53 @@ def analysis_run():
     
     print("RUN COMPLETE!!")
     pickle.dump((results, parameters), open("disc_estats.p", "wb"))  # Pickle the data
-    print("SAVED") 
-    
+    print("SAVED")
+
+def sim_params(u=u):
+    '''Dictionary of the simulation parameters. Used as key for the history cache'''
+    startlist = [(i, j) for i in range(0, grid_size, sample_steps) for j in range(0, grid_size, sample_steps)]
+    return {"grid_size": grid_size, "u": u, "r": r, "recombination_rate": recombination_rate,
+            "num_loci": num_loci, "time": time, "sample": startlist}
+
+def cached_history(seed, u=u):
+    '''Return pi, tau (tau in model time) for given seed.
+    Load them from the history cache; if not there do the DISCSIM run and save them'''
+    cache = History_Cache(cache_folder)
+    params = sim_params(u)
+    if cache.contains(params, seed):
+        return cache.load(params, seed)
+
+    trans = Unit_Transformer(grid_size, u, r)
+    sim = discsim.Simulator(grid_size)  # Create new Discsim-Simulator
+    sim.sample = [None] + params["sample"]
+    sim.event_classes = [ercs.DiscEventClass(r, u, rate=grid_size ** 2)]  # Fall with constant rate per unit area
+    sim.recombination_probability = recombination_rate
+    sim.num_loci = num_loci
+    sim.max_population_size = 100000
+    sim.random_seed = seed
+
+    advance(sim, trans, time, progress=print_progress, interval=progress_interval)
+
+    pi, tau = sim.get_history()  # Extract the necessary data
+    cache.save(pi, tau, params, seed)
+    return cache.load(params, seed)
+
+def threshold_sweep(seed, thresholds, t_ancestral=0, u=u, effective=False):
+    '''Do IBD-detection for every IBD-threshold (in loci) on the cached history of seed.
+    Return list of number of detected blocks per threshold'''
+    trans = Unit_Transformer(grid_size, u, r)
+    params = sim_params(u)
+    chrom_l = num_loci * recombination_rate * 100
+    pi, tau = cached_history(seed, u)  # Only simulated if not in the cache
+    tau = trans.to_gen_time_inplace(tau)  # Copy on write: Cache file not changed
+    det = IBD_Detector(tau, pi, recombination_rate, grid_size, params["sample"], IBD_treshold, time, chrom_l)
+
+    block_nrs = []
+    for treshold in thresholds:
+        block_nrs.append(len(det.redetect(treshold, t_ancestral, effective=effective)))
+        print("IBD-threshold: %i Number of IBD-blocks detected: %i" % (treshold, block_nrs[-1]))
+    return block_nrs
+
 
 
     
@@ -136,12 +203,10 @@ def empirical_IBD_list(save_name):
         sim.max_population_size = 100000
 
         # Do the actual run
-        for j in range(1, int(np.ceil(trans.to_model_time(time)))):  # Update to generation time!
-            print("Simulation %i Doing step: %i" % (i, j))
-            sim.run(until=(j))
+        advance(sim, trans, time, progress=print_progress, interval=progress_interval)
             
         pi, tau = sim.get_history()  # Extract the necessary data
-        tau = trans.to_gen_time(np.array(tau))  # Vectorize and measure time in Gen time.
+        pi, tau = trans.convert_history(pi, tau)  # Vectorize and measure time in Gen time.
         
         chrom_l = num_loci * recombination_rate * 100
         det = IBD_Detector(tau, pi, recombination_rate, grid_size, startlist, IBD_treshold, time, chrom_l)  # Turn on a IBD_Detector
@@ -155,51 +220,55 @@ def empirical_IBD_list(save_name):
 
 
   
+def var_sample_run(k, seed=None):
+    '''Do a single run with k randomly placed samples; return sigma estimate and number of IBD-blocks.
+    If seed is given use it as seed for DISCSIM and for the placement of the samples'''
+    position_list = [(i + sample_steps / 2, j + sample_steps / 2) for i in range(0, grid_size, sample_steps) for j in range(0, grid_size, sample_steps)]
+    Random(seed).shuffle(position_list)  # Randomize position List
+    trans = Unit_Transformer(grid_size, u, r)
+    sim = discsim.Simulator(grid_size)  # Create new Discsim-Simulator
+    sim.sample = [None] + position_list[:k]  # Set k random chromosomes
+    sim.event_classes = [ercs.DiscEventClass(r, u, rate=grid_size ** 2)]  # Fall with constant rate per unit area
+    sim.recombination_probability = recombination_rate
+    sim.num_loci = num_loci
+    sim.max_population_size = 100000
+    if seed != None:
+        sim.random_seed = seed
+    
+    # Do the run.
+    start = timer()
+    advance(sim, trans, time)
+    end = timer()
+            
+    print("\nRun time: %.2f s" % (end - start))
+    print("Total Generations: %.2f" % time)
+    
+    # Extract pedigrees and do Block detection        
+    pi, tau = sim.get_history()
+    pi, tau = trans.convert_history(pi, tau)  # Vectorize and measure time in Gen time.
+    chrom_l = num_loci * recombination_rate * 100
+    det = IBD_Detector(tau, pi, recombination_rate, grid_size, position_list[:k], IBD_treshold, time, chrom_l)  # Turn on a IBD_Detector
+    det.IBD_detection()
+    
+    block_nr = len(det.IBD_blocks)
+    print("Number of IBD-blocks detected %.2f" % block_nr)
+    
+    # Do Data mle_analysis of Blocks and extract sigma
+    data = Analysis(det)  # Do Data-Analysis and extract sigma!
+    data.fit_expdecay(show=False)
+    sigma0 = data.sigma_estimate
+    print("Sigma Estimate: %.4f\n" % sigma0)
+    return (sigma0, block_nr)
+
 def run_var_sample(save_name):
+    '''Do nr_runs runs for every number of samples in sample_sizes'''
     results = np.zeros((len(sample_sizes), nr_runs, 2))  # Container for the data
-    position_list = [(i + sample_steps / 2, j + sample_steps / 2) for i in range(0, grid_size, sample_steps) for j in range(0, grid_size, sample_steps)]
     
     '''Actual runs:'''
-    row = 0
-    for k in sample_sizes: 
+    for row, k in enumerate(sample_sizes):
         for j in range(0, nr_runs):
-            # Single run:
             print("Doing run: %.1f for %.0f samples" % (j + 1, k))
-            trans = Unit_Transformer(grid_size, u, r)
-            sim = discsim.Simulator(grid_size)  # Create new Discsim-Simulator
-            
-            shuffle(position_list)  # Randomize position List
-            sim.sample = [None] + position_list[:k]  # Set k random chromosomes
-            sim.event_classes = [ercs.DiscEventClass(r, u, rate=grid_size ** 2)]  # Fall with constant rate per unit area
-            sim.recombination_probability = recombination_rate
-            sim.num_loci = num_loci
-            sim.max_population_size = 100000
-            
-            # Do the run.
-            start = timer()
-            for i in range(1, int(np.ceil(trans.to_model_time(time)))):  # Update to generation time!
-                sim.run(until=(i))
-            end = timer()
-                    
-            print("\nRun time: %.2f s" % (end - start))
-            print("Total Generations: %.2f" % time)
-            
-            # Extract pedigrees and do Block detection        
-            pi, tau = sim.get_history()
-            tau = trans.to_gen_time(np.array(tau))  # Vectorize and measure time in Gen time.
-            det = IBD_Detector(tau, pi, recombination_rate, grid_size, position_list[:k], IBD_treshold)  # Turn on a IBD_Detector
-            det.IBD_detection()
-            
-            block_nr = len(det.IBD_list)
-            print("Number of IBD-blocks detected %.2f" % block_nr)
-            
-            # Do Data mle_analysis of Blocks and extract sigma
-            data = Analysis(det)  # Do Data-Analysis and extract sigma!
-            data.fit_expdecay(show=False)
-            sigma = data.sigma_estimate
-            print("Sigma Estimate: %.4f\n" % sigma)
-            results[row, j, :] = (sigma, block_nr)
-        row += 1  # Go one down in the results_row
+            results[row, j, :] = var_sample_run(k)
             
         print("RUN COMPLETE!!")
     parameters = (sigma, grid_size, sample_sizes, "DISCSIM")
@@ -223,6 +292,7 @@ def analysis_nb_run():
 
 
 def analyze_stats():
+    import matplotlib.pyplot as plt
     load_name = raw_input("What save to you want to load?\n") 
     (results, parameters) = pickle.load(open(load_name, "rb"))
     print(" Sigma %.2f \n Grid Size: %.2f \n Sample Steps: %.2f \n Dispersal mode: %s\n" % (parameters[0], parameters[1], parameters[2], parameters[3]))
@@ -238,6 +308,7 @@ def analyze_stats():
     print(results[:, 0].std())
 
 def analysis_nb_stats():
+    import matplotlib.pyplot as plt
     (results, parameters) = pickle.load(open("nb_stats.p", "rb"))
     # print(results)
     print(" Sigma %.2f \n Grid Size: %.2f \n Sample Steps: %.2f \n" % (parameters[0], parameters[1], parameters[2]))
@@ -296,6 +367,7 @@ def analysis_nb_stats1():
     '''Newer version of analysing various neighborhood sizes.
     Analyises only effective blocks. Prints Density and Dispersal
     estimates, and number of blocks found'''
+    import matplotlib.pyplot as plt
     (results, parameters) = pickle.load(open("nb_stats_mle.p", "rb"))
     sigma_t, grid_size, sample_steps = parameters[0], parameters[1], parameters[2]
     # print(results)
@@ -360,7 +432,7 @@ def analysis_nb_stats1():
     
 if __name__ == '__main__':
     inp = input("What do you want to do? \n (1) Run Analysis \n (2) Load Analysis\n (3) Run NB-Analysis\n"
-                " (4) Analysis NB \n (5) Run Varying samples\n (6) Create Emp. IBD-List\n")
+                " (4) Analysis NB \n (5) Run Varying samples\n (6) Create Emp. IBD-List\n (8) IBD-threshold sweep (cached)\n")
     if inp == 1:
         analysis_run()
     elif inp == 2:
@@ -377,5 +449,8 @@ if __name__ == '__main__':
     elif inp == 7:
         print("Manually copy to multi-runs please")
         # analyze_emp_IBD_list("discsim_emplist.p")
+    elif inp == 8:
+        seed = input("Which seed?\n")
+        threshold_sweep(seed, range(20, 101, 10), effective=True)
     
 
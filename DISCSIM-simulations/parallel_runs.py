@@ -0,0 +1,87 @@
+'''
+Created on Oct 19, 2026
+Runs many DISCSIM replicates in parallel over a process pool.
+Every finished replicate is appended to a results store on disk,
+so an interrupted sweep can be resumed.
+'''
+
+import cPickle as pickle
+import numpy as np
+import multiple_runs
+from process_pool import Results_Store, pool_imap  # From POPRES-Analysis
+
+base_seed = 1000  # Seeds of the runs are derived from this
+
+
+def run_job(job):
+    '''Do a single run in a worker process. job: (key, function of multiple_runs, arguments)'''
+    key, fun, args = job
+    return key, fun(*args)
+
+def run_jobs(save_name, jobs, processes=None):
+    '''Do all jobs (key, function, arguments) in parallel.
+    Results are saved to save_name as they come in; finished runs are skipped.
+    Return dictionary key: result'''
+    store = Results_Store(save_name)
+    jobs = [job for job in jobs if not store.done(job[0])]  # Resume where stopped
+    print("Runs to do: %i" % len(jobs))
+
+    for key, result in pool_imap(run_job, jobs, processes, ordered=False):
+        store.append(key, result)
+        print("Finished run %i of setting %i" % (key[1], key[0]))
+    return store.results
+
+def sweep(save_name, u_values, nr_runs, nb=True, processes=None):
+    '''Do nr_runs runs for every u in u_values in parallel.
+    Return dictionary (u index, run index): result'''
+    jobs = [((j, i), multiple_runs.single_run, (i, u_values[j], nb, base_seed + 10000 * j + i))
+            for j in range(len(u_values)) for i in range(nr_runs)]
+    return run_jobs(save_name, jobs, processes)
+
+def collect(results, nr_u, nr_runs, nr_values):
+    '''Bring results of a sweep into array u x runs x values.
+    Missing runs are nan'''
+    res = np.ones((nr_u, nr_runs, nr_values)) * np.nan
+    for (j, i), result in results.items():
+        res[j, i, :] = result
+    return res
+
+def analysis_nb_run_parallel(save_name="nb_stats_mle.p", processes=None):
+    '''Parallel version of multiple_runs.analysis_nb_run. Saves in the same format'''
+    u_range = multiple_runs.u_range
+    results = sweep(save_name + ".runs", u_range, multiple_runs.nr_runs, nb=True, processes=processes)
+    results = collect(results, len(u_range), multiple_runs.nr_runs, 3)
+    parameters = [multiple_runs.sigma, multiple_runs.grid_size, multiple_runs.sample_steps, list(u_range)]
+    pickle.dump((results, parameters), open(save_name, "wb"))  # Pickle the data
+    print("SAVED")
+
+def analysis_run_parallel(save_name="disc_estats.p", processes=None):
+    '''Parallel version of multiple_runs.analysis_run. Saves in the same format'''
+    results = sweep(save_name + ".runs", [multiple_runs.u], multiple_runs.nr_runs, nb=False, processes=processes)
+    results = collect(results, 1, multiple_runs.nr_runs, 2)[0]
+    parameters = (multiple_runs.sigma, multiple_runs.grid_size, multiple_runs.sample_steps, "DISCSIM")
+    pickle.dump((results, parameters), open(save_name, "wb"))  # Pickle the data
+    print("SAVED")
+
+def run_var_sample_parallel(save_name, processes=None):
+    '''Parallel version of multiple_runs.run_var_sample. Saves in the same format'''
+    sample_sizes, nr_runs = multiple_runs.sample_sizes, multiple_runs.nr_runs
+    jobs = [((j, i), multiple_runs.var_sample_run, (sample_sizes[j], base_seed + 10000 * j + i))
+            for j in range(len(sample_sizes)) for i in range(nr_runs)]
+    results = run_jobs(save_name + ".runs", jobs, processes)
+    results = collect(results, len(sample_sizes), nr_runs, 2)
+    parameters = (multiple_runs.sigma, multiple_runs.grid_size, sample_sizes, "DISCSIM")
+    pickle.dump((results, parameters), open(save_name, "wb"))  # Pickle the data
+    print("SAVED")
+
+
+if __name__ == '__main__':
+    inp = input("What do you want to do? \n (1) Run Analysis (parallel) \n (2) Run NB-Analysis (parallel)\n"
+                " (3) Run Varying samples (parallel)\n")
+    if inp == 1:
+        analysis_run_parallel()
+    elif inp == 2:
+        analysis_nb_run_parallel()
+    elif inp == 3:
+        save_name = raw_input("What do you want to save to?\n")
+        run_var_sample_parallel(save_name)
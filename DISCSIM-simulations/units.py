@@ -6,6 +6,7 @@ Created on Mar 4, 2015
 
 from math import pi
 from math import sqrt
+import numpy as np
 
 class Unit_Transformer(object):
     # Class for transforming units. Initialized with Discsim parameters
@@ -13,6 +14,7 @@ class Unit_Transformer(object):
     u=0
     r=0
     sigma=0
+    death_rate=0    # Generations per unit of model time
     
     
     def __init__(self, grid_size, u, r):
@@ -20,16 +22,34 @@ class Unit_Transformer(object):
         self.grid_size=grid_size    # Total grid_size
         self.u = u  # Impact
         self.r = r  # Radius
+        self.death_rate=self.r**2 * pi * self.u     # Calculate death rate once
         
     def to_gen_time(self,t):
-        # Transforms in model time to generation time        
-        death_rate=self.r**2 * pi * self.u              # Calculate death rate
-        return(t*death_rate)                            # Gives back time in generations
+        # Transforms in model time to generation time. Works for numbers and arrays
+        return(t*self.death_rate)                       # Gives back time in generations
     
     def to_model_time(self,t):
         # Transforms gen time to model time
-        death_rate=self.r**2 * pi * self.u
-        return(t/death_rate)
+        return(t/self.death_rate)
+    
+    def to_gen_time_inplace(self,t):
+        # Transforms float array t from model time to generation time in place (no copy)
+        np.multiply(t, self.death_rate, out=t)
+        return t
+    
+    def convert_history(self, pi, tau, chunk_size=100):
+        # Transforms pi and tau (as given by sim.get_history) to arrays Loci x Nodes, tau in generation time.
+        # Fills preallocated arrays chunk by chunk of loci, so no full size temporary copies are made.
+        nr_loci, nr_nodes = len(tau), len(tau[0])
+        pi_arr = np.empty((nr_loci, nr_nodes), dtype=np.min_scalar_type(nr_nodes))
+        tau_arr = np.empty((nr_loci, nr_nodes), dtype=float)
+        
+        for i in range(0, nr_loci, chunk_size):
+            j = min(i + chunk_size, nr_loci)
+            pi_arr[i:j] = pi[i:j]
+            tau_arr[i:j] = tau[i:j]
+            self.to_gen_time_inplace(tau_arr[i:j])
+        return pi_arr, tau_arr
         
     def sigma_calculator(self):
         # Calculates expected sigma
@@ -7,11 +7,7 @@ import os
 import numpy as np
 import bisect
 import itertools
-import matplotlib.pyplot as plt
-import matplotlib.cm as cmx
-import matplotlib.colors as colors
 
-from matplotlib.widgets import Slider
 from math import sqrt
 from collections import Counter
 from scipy.misc import factorial  # @UnresolvedImport
@@ -20,10 +16,7 @@ from scipy.stats import gaussian_kde
 from scipy.stats import binned_statistic
 from scipy.special import kv as kv
 # from blockpiece import Multi_Bl
-from mle_estimation import MLE_estimation  # Fitting without error
 from mle_estim_error import MLE_estim_error  # Import the MLE-estimation scheme from POPRES analysis
-from statsmodels.stats.moment_helpers import cov2corr
-from matplotlib import collections  as mc  # For plotting lines
 
 
 class Analysis(object):
@@ -54,6 +47,8 @@ class Analysis(object):
    
     def plot_chromosome_slider(self):
         '''Do a slider plot for the correlograms'''
+        import matplotlib.pyplot as plt
+        from matplotlib.widgets import Slider
         fig = plt.figure()
         ax = plt.subplot(111)
         fig.subplots_adjust(left=0.25, bottom=0.25)
@@ -99,10 +94,13 @@ class Analysis(object):
             blocks = self.IBD_blocks
         pair_distance = [torus_distance(element[2][0], element[2][1], element[3][0], element[3][1], self.gridsize) for element in blocks]
                   
-        # Plot the result in a histogram:
-        counts, bins, patches = plt.hist(pair_distance, n_bins, facecolor='g', alpha=0.9)  # @UnusedVariable
+        # Bin the result (same binning as the histogram plot):
+        counts, bins = np.histogram(pair_distance, n_bins)
+        counts = counts.astype('float')
 
         if show == True:
+            import matplotlib.pyplot as plt
+            plt.hist(pair_distance, bins, facecolor='g', alpha=0.9)
             plt.xlabel('Distance')
             plt.ylabel('Number of shared blocks')
             plt.title('Histogram of IBD')
@@ -144,6 +142,7 @@ class Analysis(object):
         
     def plot_expdecay(self, logy=True):
         '''Plot the IBD results; The boolean logy determines if log_scale is used'''
+        import matplotlib.pyplot as plt
         self.IBD_analysis()
         distance_mean, results, _ = self.IBD_results
             
@@ -182,6 +181,7 @@ class Analysis(object):
         print("Exact Bessel fit: \nC: %.4G \nr: %.4G" % (C1, r1))
         
         if show == True:  # Do a plot of the fit:
+            import matplotlib.pyplot as plt
             x_plot = np.linspace(min(x), max(x), 10000)
             plt.figure()
             plt.yscale('log')
@@ -201,6 +201,7 @@ class Analysis(object):
     
     def fit_specific_length(self, interval, show=True):
         '''Fit Bessel decay for blocks of specific length'''
+        import matplotlib.pyplot as plt
         block_list = [block for block in self.IBD_blocks if interval[0] <= block[1] <= interval[1]]  # Update the block-List
         
         self.IBD_analysis(show=show, blocks=block_list)
@@ -271,6 +272,7 @@ class Analysis(object):
                 
     def which_blocks(self):
         '''Analyze Distribution of origin of blocks contributing to IBD'''
+        import matplotlib.pyplot as plt
         origin_list = []
         for IBD_block in self.IBD_blocks:
             origin_list.append(IBD_block[2])
@@ -323,6 +325,7 @@ class Analysis(object):
         
     def which_times(self, n_bins=30):
         '''Shows distribution of times when blocks coalesced.'''
+        import matplotlib.pyplot as plt
         c_times = [block[4] for block in self.IBD_blocks]
         c_distances = [torus_distance(block[2][0], block[2][1], block[3][0], block[3][1], self.gridsize) 
                        for block in self.IBD_blocks]
@@ -361,6 +364,7 @@ class Analysis(object):
     def plot_fitted_data(self): 
         '''Plots the fit to the binned data set    
         This very specific plot method visualizes IBD-sharing '''
+        import matplotlib.pyplot as plt
         f, axarr = plt.subplots(2, 3, sharex=True)  # Create sub-plots
         # intervals = ([3.0, 3.5], [3.5, 4.0], [4.0, 4.5], [4.5, 5], [5.0, 6], [6.0, 7], [7.0, 8.5], [8.5, 10])  # Set the interval-list
         intervals = ([5, 5.2], [6, 6.4], [7, 7.4], [8, 8.5], [10, 10.5], [15, 15.8])  # Set the interval-list
@@ -394,6 +398,7 @@ class Analysis(object):
     
     def mle_estimate(self, endog, exog):
         '''MLE estimate'''
+        from mle_estimation import MLE_estimation  # Fitting without error
         ml_estimator = MLE_estimation(endog, exog)
         print("Doing fit")
         results = ml_estimator.fit()  # method="nelder-mead"
@@ -415,14 +420,16 @@ class Analysis(object):
     def mle_estimate_error(self):
         '''MLE-estimation from the POPRES analysis. Bins the data. And can deal with errors.
         Param[0] always C; Param[1] always sigma'''
+        from statsmodels.stats.moment_helpers import cov2corr
         # First create mle_object
         pw_dist, pw_IBD, pair_nr = self.give_pairwise_statistics()  # Create full pw. statistics
         pw_dist, pw_IBD, pair_nr = self.bin_pairwise_statistics(pw_dist, pw_IBD, pair_nr)
         bl_shr_density = uniform_density
         start_params = [1.0, 2.0]  # 1: D 2: Sigma
         
-        # Create MLE_estimation object:
-        ml_estimator = MLE_estim_error(bl_shr_density, start_params, pw_dist, pw_IBD, pair_nr, error_model=False) 
+        # Create MLE_estimation object. Analytic score and Hessian (for the fit and the standard errors):
+        ml_estimator = MLE_estim_error(bl_shr_density, start_params, pw_dist, pw_IBD, pair_nr, error_model=False,
+                                       density_derivs=True) 
         self.estimates = start_params  # Best guess without doing anything. Used as start for Bootstrap
         
         print("Doing fit...")
@@ -430,7 +437,7 @@ class Analysis(object):
         # results0 = ml_estimator.fit(method="BFGS")  # Do the actual fit. method="BFGS" possible
         self.estimates = results.params  # Save the paramter estimates
             
-        fisher_info = np.matrix(ml_estimator.hessian(results.params))  # Get the Fisher Info matrix
+        fisher_info = np.matrix(ml_estimator.hessian(results.params))  # Get the Fisher Info matrix (analytic)
         corr_mat = cov2corr(-fisher_info.I)
         print(corr_mat)
         stds = np.sqrt(np.diag(-fisher_info.I))
@@ -448,6 +455,8 @@ class Analysis(object):
     
     def plot_blocks(self):
         '''Plots all pairwise shared blocks'''
+        import matplotlib.pyplot as plt
+        from matplotlib import collections  as mc  # For plotting lines
         ibd_blocks, start_list = self.IBD_blocks, self.start_list  # Load rel. data
         print(start_list)
         print(ibd_blocks[0])
@@ -593,9 +602,13 @@ def bessel_decay_interval(r, C, sigma, interval):
     b_l = C * r ** 2 / (2 * l / 100.0 * sigma ** 2) * kv(2, np.sqrt(2 * l / 100.0) * r / sigma)
     return b_l * (interval[1] - interval[0]) / 100.0
 
-def uniform_density(l, r, params):
-    '''Gives uniform density per cM(!) If l vector return vector'''
+def uniform_density(l, r, params, deriv=False):
+    '''Gives uniform density per cM(!) If l vector return vector.
+    deriv: Return value, gradient and Hessian; G times the Bessel basis of the POPRES analysis'''
     G = 1.5
+    if deriv:
+        from mle_analysis import bd_basis_derivs
+        return tuple(G * t for t in bd_basis_derivs(l / 100.0, r, params[0], params[1], 0))
     D = params[0]  # Density
     sigma = params[1]
     C = G / (4 * np.pi * sigma ** 2 * D)  # The constant in front
@@ -606,6 +619,8 @@ def uniform_density(l, r, params):
 def get_cmap(N):
     '''Returns a function that maps each index in 0, 1, ... N-1 to a distinct 
     RGB color'''
+    import matplotlib.cm as cmx
+    import matplotlib.colors as colors
     color_norm = colors.Normalize(vmin=0, vmax=N - 1)
     scalar_map = cmx.ScalarMappable(norm=color_norm, cmap='hsv') 
     def map_index_to_rgb_color(index):
@@ -634,6 +649,7 @@ def save(path, ext='png', close=True, verbose=True):
     Whether to print information about when and where the image
     has been saved.
     """
+    import matplotlib.pyplot as plt
     # Extract the directory and filename from the given path
     directory = os.path.split(path)[0]
     filename = "%s.%s" % (os.path.split(path)[1], ext)
@@ -0,0 +1,66 @@
+'''
+Created on Oct 19, 2026
+Index over the block lengths of many pairs (e.g. country pairs).
+The blocks of every pair are sorted once; the number of blocks in any
+length interval is then found for all pairs at once with two searchsorted
+calls on composite keys (pair index * span + block length).
+'''
+
+import numpy as np
+
+
+class Block_Index(object):
+    '''
+    Sorted block lengths of all pairs, with the positions where every pair starts.
+    '''
+    source = []  # Block lists the index was built from
+    lengths = []  # Sorted block lengths; pair by pair
+    keys = []  # Composite keys: pair index * span + block length (sorted)
+    starts = []  # Position of the first block of every pair in lengths (and the end of the last)
+    span = 2.0  # Larger than the longest block + 1; separates the pairs in keys
+
+    def __init__(self, block_lists):
+        '''block_lists: List (or object array) with the block lengths of every pair'''
+        self.source = block_lists
+        nrs = np.array([len(b_s) for b_s in block_lists], dtype=int)
+        lengths = np.concatenate([np.asarray(b_s, dtype=float) for b_s in block_lists] + [np.zeros(0)])
+        pair_ids = np.repeat(np.arange(len(nrs)), nrs)
+
+        order = np.lexsort((lengths, pair_ids))  # Sort by pair; within pair by length
+        self.lengths = lengths[order]
+        self.starts = np.concatenate(([0], np.cumsum(nrs)))
+        self.span = np.max(self.lengths) + 2.0 if len(self.lengths) > 0 else 2.0
+        self.keys = pair_ids * self.span + self.lengths
+
+    def pair_bounds(self, min_len, max_len, strict=False):
+        '''Positions in lengths of the first block in the interval and after the last one, for every pair.
+        Interval [min_len, max_len]; (min_len, max_len) if strict'''
+        max_l = self.span - 2.0
+        min_len, max_len = np.clip([min_len, max_len], -0.5, max_l + 0.5)  # Keep the keys within the pair
+        base = np.arange(len(self.starts) - 1) * self.span
+        lo = np.searchsorted(self.keys, base + min_len, side="right" if strict else "left")
+        hi = np.searchsorted(self.keys, base + max_len, side="left" if strict else "right")
+        return lo, np.maximum(hi, lo)
+
+    def count(self, min_len, max_len, strict=False):
+        '''Number of blocks in [min_len, max_len] for every pair; (min_len, max_len) if strict'''
+        lo, hi = self.pair_bounds(min_len, max_len, strict)
+        return hi - lo
+
+    def blocks(self, min_len, max_len, strict=False):
+        '''Object array with the (sorted) blocks in [min_len, max_len] of every pair; (min_len, max_len) if strict'''
+        lo, hi = self.pair_bounds(min_len, max_len, strict)
+        block_lists = np.empty(len(lo), dtype=np.object)
+        for i in range(len(lo)):
+            block_lists[i] = self.lengths[lo[i]:hi[i]]  # Views; no copies
+        return block_lists
+
+
+######################### Some lines to test the code
+if __name__ == "__main__":
+    block_lists = [list(np.random.exponential(5, np.random.poisson(3))) for _ in range(1000)]
+    index = Block_Index(block_lists)
+    for min_len, max_len in ([0, 150], [4, 6], [5.5, 5.5], [-1, 1000]):
+        counts = np.array([np.sum((np.array(b_s) >= min_len) * (np.array(b_s) <= max_len)) for b_s in block_lists])
+        counts1 = np.array([np.sum((np.array(b_s) > min_len) * (np.array(b_s) < max_len)) for b_s in block_lists])
+        print(np.all(index.count(min_len, max_len) == counts), np.all(index.count(min_len, max_len, strict=True) == counts1))
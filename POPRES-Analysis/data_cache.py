@@ -0,0 +1,161 @@
+'''
+Created on Oct 19, 2026
+Binary cache for the pre-processed POPRES data.
+Saves the fields of LoadData needed by MLE_analyse, so that
+the csv parsing and distance calculation is only done once.
+The content hashes of the input files are kept in a sidecar file by
+(path, size, modification time); so a cache hit only needs a stat per file.
+'''
+
+import os
+import json
+import hashlib
+import numpy as np
+
+cache_version = 1  # Increase when the saved format changes
+hashes_name = "popres_file_hashes.json"  # Sidecar file with the content hashes of the input files
+
+
+class Preprocessed_Data(object):
+    '''Container with the same data fields as LoadData that MLE_analyse uses'''
+    countries_oi = []
+    pw_distances = []  # Pairwise distance Matrix
+    pw_blocksharing = []  # Matrix of block sharing between countries
+    nr_individuals = []
+
+    def __init__(self, countries_oi, pw_distances, pw_blocksharing, nr_individuals):
+        self.countries_oi = countries_oi
+        self.pw_distances = pw_distances
+        self.pw_blocksharing = pw_blocksharing
+        self.nr_individuals = nr_individuals
+
+
+def load_file_hashes(cache_folder):
+    '''Dictionary path: {size, mtime, md5} from the sidecar file. Empty if none (or broken)'''
+    path = os.path.join(cache_folder, hashes_name)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+def save_file_hashes(hashes, cache_folder):
+    '''Save the dictionary of file hashes to the sidecar file'''
+    path = os.path.join(cache_folder, hashes_name)
+    temp_path = path + ".tmp"  # Write to temporary file first, so no broken sidecar remains
+    with open(temp_path, "w") as f:
+        json.dump(hashes, f, sort_keys=True)
+    os.rename(temp_path, path)
+
+def file_hash(path, hashes):
+    '''md5 of the content of the file at path. Memoized in hashes by path, size and
+    modification time: An unchanged file is not read again. Return hex digest'''
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    entry = hashes.get(key)
+    if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+        return entry["md5"]
+
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b""):
+            md5.update(chunk)
+    hashes[key] = {"size": stat.st_size, "mtime": stat.st_mtime, "md5": md5.hexdigest()}
+    return hashes[key]["md5"]
+
+def get_cache_key(paths, min_block_length, countries_oi, cache_folder="./"):
+    '''Hash of the content of the input files, the minimum block length and the countries.
+    File hashes are memoized in the sidecar file in cache_folder'''
+    hashes = load_file_hashes(cache_folder)
+    changed = False  # Whether the sidecar has to be updated
+    md5 = hashlib.md5()
+    for path in paths:
+        old_entry = hashes.get(os.path.abspath(path))
+        md5.update(file_hash(path, hashes).encode("utf-8"))
+        changed = changed or hashes[os.path.abspath(path)] != old_entry
+    if changed:
+        save_file_hashes(hashes, cache_folder)
+    md5.update(("%r %r %i" % (float(min_block_length), list(countries_oi), cache_version)).encode("utf-8"))
+    return md5.hexdigest()
+
+def save_cache(data, cache_path):
+    '''Save data object (LoadData) to cache_path. Block sharing is flattened
+    to one array of block lengths and the number of blocks per country pair'''
+    k = len(data.countries_oi)
+    bl_nrs = np.array([len(data.pw_blocksharing[i, j]) for i in range(k) for j in range(k)])
+    bl_lengths = np.array([l for i in range(k) for j in range(k) for l in data.pw_blocksharing[i, j]], dtype=float)
+
+    temp_path = cache_path + ".tmp.npz"  # Write to temporary file first, so no broken cache remains
+    np.savez(temp_path, version=cache_version, countries_oi=np.array(data.countries_oi),
+             pw_distances=data.pw_distances, nr_individuals=np.array(data.nr_individuals),
+             bl_nrs=bl_nrs, bl_lengths=bl_lengths)
+    os.rename(temp_path, cache_path)
+    print("Saved pre-processed data to %s" % cache_path)
+
+def load_cache(cache_path):
+    '''Load Preprocessed_Data from cache_path. Return 0 if no valid cache found'''
+    if not os.path.exists(cache_path):
+        return 0
+    cache = np.load(cache_path)
+    if int(cache["version"]) != cache_version:
+        print("Cache version outdated: %s" % cache_path)
+        return 0
+
+    countries_oi = cache["countries_oi"]
+    k = len(countries_oi)
+    bl_nrs = cache["bl_nrs"]
+    pw_blocksharing = np.empty(k * k, dtype=np.object)
+    for i, blocks in enumerate(np.split(cache["bl_lengths"], np.cumsum(bl_nrs)[:-1])):
+        pw_blocksharing[i] = blocks.tolist()
+    pw_blocksharing = pw_blocksharing.reshape((k, k))
+
+    print("Loaded pre-processed data from %s" % cache_path)
+    return Preprocessed_Data(countries_oi, cache["pw_distances"], pw_blocksharing, cache["nr_individuals"])
+
+def load_data(pop_path, ibd_list_path, geo_path, min_block_length, countries_oi, cache_folder="./", visualize=True):
+    '''Return pre-processed data. Loaded from cache if possible; otherwise
+    processed with LoadData and then saved to the cache. visualize: Passed on to LoadData'''
+    key = get_cache_key([pop_path, ibd_list_path, geo_path], min_block_length, countries_oi, cache_folder)
+    cache_path = os.path.join(cache_folder, "popres_cache_" + key + ".npz")
+
+    data = load_cache(cache_path)
+    if data:
+        return data
+
+    from loaddata import LoadData  # Only import heavy processing if needed
+    data = LoadData(pop_path, ibd_list_path, geo_path, min_block_length, countries_oi, visualize=visualize)
+    save_cache(data, cache_path)
+    return data
+
+
+######################### Some lines to test the code
+def check_file_hashes(folder="test_hashes/"):
+    '''An unchanged file is not hashed again; a changed one is'''
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    path = os.path.join(folder, "ibd_list.csv")
+    with open(path, "w") as f:
+        f.write("id1,id2,chr,length\n1,2,chr1,5.0\n")
+    key = get_cache_key([path], 4.0, ["FR"], folder)
+    assert key == get_cache_key([path], 4.0, ["FR"], folder)
+
+    hashes = load_file_hashes(folder)
+    hashes[os.path.abspath(path)]["md5"] = "memoized"  # Only a memoized hash can give this
+    save_file_hashes(hashes, folder)
+    assert file_hash(path, load_file_hashes(folder)) == "memoized"
+
+    with open(path, "a") as f:
+        f.write("1,3,chr2,6.0\n")  # Changes the size
+    assert get_cache_key([path], 4.0, ["FR"], folder) != key
+    assert load_file_hashes(folder)[os.path.abspath(path)]["md5"] != "memoized"
+
+    os.remove(path)
+    os.remove(os.path.join(folder, hashes_name))
+    os.rmdir(folder)
+    print("File hashes okay")
+
+
+if __name__ == "__main__":
+    check_file_hashes()
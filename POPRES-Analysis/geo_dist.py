@@ -0,0 +1,125 @@
+'''
+Created on Oct 19, 2026
+Vectorized great circle distances between geographic coordinates.
+Vincenty's inverse formula on the WGS-84 ellipsoid (as geopy's vincenty)
+and the haversine formula; both work on whole numpy arrays.
+All coordinates in degrees, all distances in km.
+'''
+
+import numpy as np
+
+a = 6378.137  # WGS-84 major axis (km)
+f = 1 / 298.257223563  # WGS-84 flattening
+b = (1 - f) * a  # WGS-84 minor axis (km)
+earth_radius = 6371.009  # Mean earth radius (km); for haversine
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    '''Great circle distance on a sphere. Broadcasts over arrays'''
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(x, dtype=float)) for x in (lat1, lon1, lat2, lon2)]
+    h = np.sin((lat2 - lat1) / 2.0) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.0) ** 2
+    return 2 * earth_radius * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+def vincenty(lat1, lon1, lat2, lon2, max_iter=200, tol=1e-12):
+    '''Vincenty distance on the WGS-84 ellipsoid. Broadcasts over arrays.
+    Pairs where the iteration does not converge (nearly antipodal points)
+    get the haversine distance'''
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in (lat1, lon1, lat2, lon2)])
+    U1 = np.arctan((1 - f) * np.tan(np.radians(lat1)))  # Reduced latitudes
+    U2 = np.arctan((1 - f) * np.tan(np.radians(lat2)))
+    sinU1, cosU1, sinU2, cosU2 = np.sin(U1), np.cos(U1), np.sin(U2), np.cos(U2)
+    L = np.radians(lon2 - lon1)
+    lam = L.copy()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for _ in range(max_iter):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.sqrt((cosU2 * sin_lam) ** 2 + (cosU1 * sinU2 - sinU1 * cosU2 * cos_lam) ** 2)
+            cos_sigma = sinU1 * sinU2 + cosU1 * cosU2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma > 0, cosU1 * cosU2 * sin_lam / sin_sigma, 0.0)
+            cos_sq_alpha = 1 - sin_alpha ** 2
+            cos2_sigma_m = np.where(cos_sq_alpha > 0, cos_sigma - 2 * sinU1 * sinU2 / cos_sq_alpha, 0.0)  # Equatorial line: 0
+            C = f / 16 * cos_sq_alpha * (4 + f * (4 - 3 * cos_sq_alpha))
+            lam_prev = lam
+            lam = L + (1 - C) * f * sin_alpha * (sigma + C * sin_sigma *
+                                                 (cos2_sigma_m + C * cos_sigma * (-1 + 2 * cos2_sigma_m ** 2)))
+            converged = np.abs(lam - lam_prev) <= tol
+            if np.all(converged):
+                break
+
+    u_sq = cos_sq_alpha * (a ** 2 - b ** 2) / b ** 2
+    A = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    B = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = B * sin_sigma * (cos2_sigma_m + B / 4 * (cos_sigma * (-1 + 2 * cos2_sigma_m ** 2) -
+                    B / 6 * cos2_sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos2_sigma_m ** 2)))
+    dist = b * A * (sigma - delta_sigma)
+
+    failed = ~converged | np.isnan(dist)
+    if np.any(failed):
+        dist[failed] = haversine(lat1[failed], lon1[failed], lat2[failed], lon2[failed])
+    return dist
+
+def dist_chunks(lats, lons, lats2=None, lons2=None, method="vincenty", chunk_size=1000):
+    '''Generator over row blocks of the distance matrix between (lats, lons) and (lats2, lons2).
+    Yields (first row index, block of chunk_size rows). For more locations than fit into memory'''
+    dist_fun = {"vincenty": vincenty, "haversine": haversine}[method]
+    lats, lons = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+    if lats2 is None:
+        lats2, lons2 = lats, lons
+    lats2, lons2 = np.asarray(lats2, dtype=float), np.asarray(lons2, dtype=float)
+
+    for i in range(0, len(lats), chunk_size):
+        j = min(i + chunk_size, len(lats))
+        yield i, dist_fun(lats[i:j, None], lons[i:j, None], lats2[None, :], lons2[None, :])
+
+def dist_matrix(lats, lons, lats2=None, lons2=None, method="vincenty", chunk_size=0, dtype=float):
+    '''Matrix of distances between all (lats, lons) and (lats2, lons2) (default: the same points).
+    chunk_size>0: Fill the matrix in blocks of rows, so temporary arrays stay small'''
+    if chunk_size <= 0:
+        chunk_size = len(lats)
+    n2 = len(lats) if lats2 is None else len(lats2)
+    dist_mat = np.empty((len(lats), n2), dtype=dtype)
+    for i, block in dist_chunks(lats, lons, lats2, lons2, method=method, chunk_size=max(chunk_size, 1)):
+        dist_mat[i:i + len(block)] = block
+    return dist_mat
+
+def pair_dist_histogram(lats, lons, bins, method="vincenty", chunk_size=200):
+    '''Histogram of the distances of all unordered pairs of points, computed in chunks
+    of rows, so the full distance matrix is never held in memory.
+    Return the number of pairs and the sum of their distances per bin'''
+    dist_fun = {"vincenty": vincenty, "haversine": haversine}[method]
+    lats, lons = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+    counts = np.zeros(len(bins) - 1)
+    dist_sums = np.zeros(len(bins) - 1)
+
+    for i in range(0, len(lats), chunk_size):
+        j = min(i + chunk_size, len(lats))
+        rows, cols = np.arange(i, j)[:, None], np.arange(j)[None, :]
+        block = dist_fun(lats[i:j, None], lons[i:j, None], lats[None, :j], lons[None, :j])
+        dists = block[cols < rows]  # Every pair only once
+        counts += np.histogram(dists, bins)[0]
+        dist_sums += np.histogram(dists, bins, weights=dists)[0]
+    return counts, dist_sums
+
+def check_against_geopy(lats, lons, method="vincenty"):
+    '''Compare the distance matrix to geopy's vincenty for all pairs.
+    Returns the maximum absolute difference (in km)'''
+    from geopy.distance import vincenty as geopy_vincenty
+    dist_mat = dist_matrix(lats, lons, method=method)
+    max_diff = 0
+    for i in range(len(lats)):
+        for j in range(i):
+            d = geopy_vincenty((lats[i], lons[i]), (lats[j], lons[j])).meters / 1000.0
+            max_diff = max(max_diff, abs(d - dist_mat[i, j]))
+    print("Maximum difference to geopy: %.6f km" % max_diff)
+    return max_diff
+
+
+######################### Some lines to test the code
+if __name__ == "__main__":
+    lats = np.random.uniform(35, 65, 100)  # Random points in Europe
+    lons = np.random.uniform(-10, 40, 100)
+    check_against_geopy(lats, lons)
+    check_against_geopy(lats, lons, method="haversine")
+    print(np.max(np.abs(dist_matrix(lats, lons, chunk_size=7) - dist_matrix(lats, lons))))
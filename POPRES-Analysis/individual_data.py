@@ -0,0 +1,108 @@
+'''
+Created on Oct 19, 2026
+Block sharing data at the level of individuals (not pooled into countries).
+Only pairs sharing at least one block are stored; all other pairs are
+summarized as counts per geographic distance bin. Approximation: The pairs
+without sharing of a bin are all evaluated at the mean distance of their bin
+(error second order in bin_width; exact if the likelihood is linear in r
+within a bin). Visiting them one by one would mean all n^2 pairs per
+evaluation. Gives the data in the
+linearized form (distances, block lists, pair numbers) used by
+MLE_analyse and MLE_estim_error.
+'''
+
+import numpy as np
+import geo_dist
+from loaddata import read_ibd_list
+
+
+class Individual_Data(object):
+    '''
+    Loads individual coordinates and shared blocks and stores the pairs sparsely.
+    Pairs without sharing are only kept as distance histogram (evaluated at the bin means).
+    '''
+    ind_ids = []  # Ids of all individuals with coordinates (sorted)
+    coords = []  # Latitude, longitude of every individual
+    pair_inds = []  # Index pairs (i, j), i > j, of individuals sharing at least one block
+    pair_dists = []  # Geographic distance of these pairs (km)
+    pair_blocks = []  # Object array with the list of shared block lengths per pair
+    dist_bins = []  # Edges of the distance bins for the pairs without sharing (km)
+    all_pair_nr = []  # Number of all pairs per distance bin
+    all_dist_sums = []  # Sum of distances of all pairs per distance bin
+    bin_width = 10.0  # Width of the distance bins (km)
+    max_dist = 20040.0  # Maximum distance on earth (km)
+
+    def __init__(self, ibd_list_path, coord_path, min_block_length, bin_width=10.0, method="vincenty", chunk_size=200):
+        '''Loads the data. coord_path: csv with individual id, latitude, longitude (one header line).
+        All pairs are only visited once in chunks, for the distance histogram'''
+        self.bin_width = bin_width
+        print("Loading data...")
+        coords = np.loadtxt(coord_path, delimiter=',', skiprows=1, usecols=(0, 1, 2))
+        order = np.argsort(coords[:, 0])
+        self.ind_ids = coords[order, 0].astype(np.int64)
+        self.coords = coords[order, 1:]
+        blocks = read_ibd_list(ibd_list_path, min_block_length)
+        print("Total number of inds: %i" % len(self.ind_ids))
+        print("Total number of blocks > %.2f cM: %i" % (min_block_length, len(blocks)))
+
+        self.set_sharing_pairs(blocks, method)
+
+        self.dist_bins = np.arange(0, self.max_dist + bin_width, bin_width)
+        print("Binning distances of all pairs...")
+        self.all_pair_nr, self.all_dist_sums = geo_dist.pair_dist_histogram(self.coords[:, 0], self.coords[:, 1],
+                                                                          self.dist_bins, method=method, chunk_size=chunk_size)
+
+    def get_ind_index(self, ids):
+        '''Index of individuals in ind_ids; -1 if no coordinates known'''
+        pos = np.searchsorted(self.ind_ids, ids).clip(0, len(self.ind_ids) - 1)
+        return np.where(self.ind_ids[pos] == ids, pos, -1)
+
+    def set_sharing_pairs(self, blocks, method="vincenty"):
+        '''Group the blocks by pair of individuals. Sets pair_inds, pair_dists and pair_blocks'''
+        ind1, ind2 = self.get_ind_index(blocks['id1']), self.get_ind_index(blocks['id2'])
+        keep = (ind1 >= 0) & (ind2 >= 0) & (ind1 != ind2)  # Only individuals with coordinates
+        ind1, ind2, lengths = np.maximum(ind1[keep], ind2[keep]), np.minimum(ind1[keep], ind2[keep]), blocks['length'][keep]
+
+        n = len(self.ind_ids)
+        pair_keys = ind1 * n + ind2
+        order = np.argsort(pair_keys, kind='mergesort')  # Stable: Keep order of blocks within pair
+        pair_keys, lengths = pair_keys[order], lengths[order]
+        keys, starts = np.unique(pair_keys, return_index=True)
+
+        self.pair_inds = np.column_stack((keys // n, keys % n))
+        self.pair_blocks = np.empty(len(keys), dtype=np.object)
+        for i, bl_lengths in enumerate(np.split(lengths, starts[1:])):
+            self.pair_blocks[i] = bl_lengths
+        lat, lon = self.coords[:, 0], self.coords[:, 1]
+        dist_fun = {"vincenty": geo_dist.vincenty, "haversine": geo_dist.haversine}[method]
+        self.pair_dists = dist_fun(lat[self.pair_inds[:, 0]], lon[self.pair_inds[:, 0]],
+                                   lat[self.pair_inds[:, 1]], lon[self.pair_inds[:, 1]])
+        print("Pairs sharing blocks: %i" % len(keys))
+
+    def give_lin_data(self, min_len, max_len):
+        '''Return linearized data (distances, block lists, pair numbers) for MLE_analyse.
+        One entry for every pair sharing a block in [min_len, max_len];
+        one entry per distance bin for all other pairs. These pairs are approximated as all
+        at the mean distance of their bin; make bin_width smaller for a finer approximation.'''
+        blocks = np.empty(len(self.pair_blocks), dtype=np.object)
+        for i, b_s in enumerate(self.pair_blocks):
+            blocks[i] = b_s[(b_s >= min_len) & (b_s <= max_len)]
+        sharing = np.array([len(b_s) > 0 for b_s in blocks], dtype=bool)
+
+        # Subtract the sharing pairs from the histogram of all pairs:
+        bin_inds = np.digitize(self.pair_dists[sharing], self.dist_bins) - 1
+        zero_nr = self.all_pair_nr - np.bincount(bin_inds, minlength=len(self.all_pair_nr))
+        zero_sums = self.all_dist_sums - np.bincount(bin_inds, weights=self.pair_dists[sharing], minlength=len(self.all_pair_nr))
+        filled = zero_nr > 0
+        zero_dists = zero_sums[filled] / zero_nr[filled]  # Mean distance per bin
+
+        empty = np.empty(np.sum(filled), dtype=np.object)
+        for i in range(len(empty)):
+            empty[i] = np.array([])
+        print("Pairs sharing blocks of interest: %i" % np.sum(sharing))
+        print("Distance bins of pairs without sharing: %i" % len(empty))
+
+        lin_dists = np.concatenate((self.pair_dists[sharing], zero_dists))
+        lin_block_sharing = np.concatenate((blocks[sharing], empty))
+        lin_pair_nr = np.concatenate((np.ones(np.sum(sharing)), zero_nr[filled]))
+        return lin_dists, lin_block_sharing, lin_pair_nr
@@ -0,0 +1,107 @@
+'''
+Created on Oct 19, 2026
+Log likelihood surfaces and profile likelihoods of an MLE_estim_error model.
+The grid points are evaluated in chunks over a process pool (the model is
+built once in the parent and inherited by fork). Profiles maximize over the
+other parameters; every inner fit is warm-started from its neighbour on the grid.
+Everything is returned as arrays; plotting is done by the caller.
+'''
+
+import numpy as np
+from scipy.optimize import minimize
+from process_pool import pool_map
+
+grid_model = 0  # Model the grid is evaluated for. Set before the pool is started
+chunk_size = 50  # Number of grid points per job
+
+
+def loglike_chunk(params_list):
+    '''Log likelihood for every parameter vector in params_list (worker)'''
+    return np.array([grid_model.loglike(params) for params in params_list])
+
+def run_pool(model, fun, jobs, processes=None):
+    '''Run fun on all jobs over a process pool for model. No print out per evaluation meanwhile'''
+    global grid_model
+    grid_model = model
+    verbose, model.verbose = model.verbose, False
+    try:
+        return pool_map(fun, jobs, processes)
+    finally:
+        model.verbose = verbose  # As set by the caller
+
+def grid_loglike(model, params_list, processes=None):
+    '''Log likelihood of model for every row of params_list (points x parameters). Return vector'''
+    params_list = np.asarray(params_list, dtype=float)
+    chunks = [params_list[i:i + chunk_size] for i in range(0, len(params_list), chunk_size)]
+    return np.concatenate(run_pool(model, loglike_chunk, chunks, processes))
+
+def loglike_surface(model, params, inds, x_vec, y_vec, processes=None):
+    '''Log likelihood surface over parameters inds[0] (values x_vec) and inds[1] (values y_vec).
+    All other parameters fixed to params. Return matrix (y_vec x x_vec) as for np.meshgrid'''
+    xv, yv = np.meshgrid(x_vec, y_vec)
+    params_list = np.tile(np.asarray(params, dtype=float), (xv.size, 1))
+    params_list[:, inds[0]], params_list[:, inds[1]] = xv.flatten(), yv.flatten()
+    return grid_loglike(model, params_list, processes).reshape(xv.shape)
+
+def profile_path(job):
+    '''Maximize the log likelihood over the free parameters along a path of fixed values (worker).
+    job: (fixed indices, list of fixed values, start params). Every fit starts at the last optimum.
+    Return the profile log likelihoods and the optimal parameters'''
+    fixed, path, params = job
+    params = np.array(params, dtype=float)
+    free = [i for i in range(len(params)) if i not in fixed]
+    lls, opt_params = [], []
+    for values in path:
+        params[fixed] = values
+        if len(free) == 0:  # Nothing to maximize
+            lls.append(grid_model.loglike(params))
+            opt_params.append(params.copy())
+            continue
+
+        def neg_ll(x):
+            params[free] = x
+            return -grid_model.loglike(params)
+
+        if grid_model.density_derivs == True:  # Gradient based with the analytic score; C, sigma > 0
+            def neg_score(x):
+                params[free] = x
+                return -grid_model.score(params)[free]
+            bounds = [(1e-12, None) if i < 2 else (None, None) for i in free]
+            fit = minimize(neg_ll, params[free], jac=neg_score, method="L-BFGS-B", bounds=bounds)
+        else:
+            fit = minimize(neg_ll, params[free], method="Nelder-Mead")
+        params[free] = fit.x  # Warm start for the next value
+        lls.append(-fit.fun)
+        opt_params.append(params.copy())
+    return np.array(lls), np.array(opt_params)
+
+def run_paths(model, jobs, processes=None):
+    '''Run the profile paths in parallel. Return list of results'''
+    return run_pool(model, profile_path, jobs, processes)
+
+def profile_likelihood(model, params, ind, values, processes=None):
+    '''Profile log likelihood of parameter ind at values, starting from the estimates params.
+    The paths below and above params[ind] run outward from the estimate in parallel.
+    Return profile log likelihoods and optimal parameters (values x parameters)'''
+    values = np.asarray(values, dtype=float)
+    order = np.argsort(values)
+    below = [i for i in order[::-1] if values[i] < params[ind]]  # From the estimate outward
+    above = [i for i in order if values[i] >= params[ind]]
+    jobs = [([ind], [[values[i]] for i in path], params) for path in (below, above)]
+
+    lls, opt_params = np.zeros(len(values)), np.zeros((len(values), len(params)))
+    for path, (path_lls, path_params) in zip((below, above), run_paths(model, jobs, processes)):
+        if len(path) > 0:
+            lls[path], opt_params[path] = path_lls, path_params
+    return lls, opt_params
+
+def profile_surface(model, params, inds, x_vec, y_vec, processes=None):
+    '''Profile log likelihood surface over parameters inds[0] (x_vec) and inds[1] (y_vec);
+    maximized over all other parameters. Every row of the grid is a warm-started path; the rows
+    run in parallel. Return matrix (y_vec x x_vec) as for np.meshgrid and the optimal parameters'''
+    inds = list(inds)
+    jobs = [(inds, [[x, y] for x in x_vec], params) for y in y_vec]
+    res = run_paths(model, jobs, processes)
+    lls = np.array([r[0] for r in res])
+    opt_params = np.array([r[1] for r in res])
+    return lls, opt_params
@@ -5,19 +5,24 @@ Created on Feb 4, 2016
 '''
 
 
+import gzip
+import itertools
 import numpy as np
-import simplekml  # To extract Google map files
-import matplotlib.pyplot as plt
-from geopy.distance import vincenty  # To compute great circle distance from coordinates
-from mpl_toolkits.basemap import Basemap
+import geo_dist  # Vectorized great circle distances
 
+# Plotting and geo libraries (simplekml, geopy, matplotlib, Basemap) are only
+# imported in the methods that need them; so computation-only runs start fast.
 
 # my_proj = Proj(proj='utm',zone="31T",ellps='WGS84',units='m')   # Prepare the Longitude/Latidude to Easting/Northing transformation
-style = simplekml.StyleMap()  # Create a style map for highlight style and normal style FOR UNCORRECTED
-style.normalstyle.labelstyle.scale = 0
-style.normalstyle.iconstyle.icon.href = "http://maps.google.com/mapfiles/kml/pushpin/red-pushpin.png"  # grn
-style.highlightstyle.labelstyle.scale = 1
-style.highlightstyle.iconstyle.icon.href = 'http://maps.google.com/mapfiles/kml/pushpin/blue-pushpin.png'
+def kml_style():
+    '''Create a style map for highlight style and normal style FOR UNCORRECTED'''
+    import simplekml
+    style = simplekml.StyleMap()
+    style.normalstyle.labelstyle.scale = 0
+    style.normalstyle.iconstyle.icon.href = "http://maps.google.com/mapfiles/kml/pushpin/red-pushpin.png"  # grn
+    style.highlightstyle.labelstyle.scale = 1
+    style.highlightstyle.iconstyle.icon.href = 'http://maps.google.com/mapfiles/kml/pushpin/blue-pushpin.png'
+    return style
 ######################################################
 
 class LoadData(object):
@@ -28,20 +33,22 @@ class LoadData(object):
     blocks = []  # Contains table of all shared blocks
     coordinates = []  # Matrix saving the coordinates of a country
     countries_oi = []
+    country_coords = []  # Latitude and longitude of the countries of interest
         
     # countries_oi = []  # List of countries of interest
     pw_distances = []  # Pairwise distance Matrix
     pw_blocksharing = []  # Matrix of block sharing between countries
     nr_individuals = []
 
-    def __init__(self, pop_path, ibd_list_path, geo_path, min_block_length, countries_oi):
-        '''Runs all the stuff to bring data in shape '''
+    def __init__(self, pop_path, ibd_list_path, geo_path, min_block_length, countries_oi, visualize=True):
+        '''Runs all the stuff to bring data in shape.
+        visualize: Whether to export the kml-file and plot the map of the countries'''
         self.countries_oi = countries_oi
         print("Loading data...")  
 
         # First load all the necessary files.
         self.populations = np.loadtxt(pop_path, dtype='string', delimiter=',')[1:, :]  # Load the cross_reference list
-        self.blocks = np.loadtxt(ibd_list_path, dtype='string', delimiter=',')[1:, :]
+        self.blocks = read_ibd_list(ibd_list_path, min_block_length)  # Typed blocks above minimum length
         self.coordinates = np.loadtxt(geo_path, dtype='string', delimiter=',')[1:, :]
         self.populations[:, 1] = [countrie.replace("\"", "") for countrie in self.populations[:, 1]]  # Replace double "" in populations
         
@@ -50,39 +57,58 @@ class LoadData(object):
         
         print(self.countries_oi)
         print("Total number of inds: %.1f" % len(self.populations))
-        print("Total number of blocks: %.1f" % len(self.blocks[:, 0]))  
+        print("Total number of blocks > %.2f cM: %.1f" % (min_block_length, len(self.blocks)))  
         
-        self.calculate_pw_dist()  # Update important fields
+        self.calculate_pw_dist(visualize)  # Update important fields
         self.calc_ind_nr() 
         k = len(self.countries_oi)
         
-        block_list = self.blocks[(self.blocks[:, 3].astype('float') > min_block_length), :]  # Only keep blocks with minimum length
-        
-        # Replace individual numbers by their country of origin:
-        for i in range(len(block_list[:, 0])):
-            ind1 = np.where(self.populations[:, 0] == block_list[i, 0])[0][0]
-            ind2 = np.where(self.populations[:, 0] == block_list[i, 1])[0][0]
-            block_list[i, 0] = self.populations[ind1, 1]
-            block_list[i, 1] = self.populations[ind2, 1]
+        # Replace individual numbers by the index of their country of origin:
+        ctry1, ctry2 = self.map_to_countries(self.blocks['id1'], self.blocks['id2'])
         
         # Generate the block sharing matrix  
         filler = np.frompyfunc(lambda x: list(), 1, 1)
         a = np.empty((k, k), dtype=np.object)
         self.pw_blocksharing = filler(a, a)  # Initialize everything to an empty list.    
-        
-        for i in range(len(block_list[:, 0])):
-            ind1 = np.where(self.countries_oi == block_list[i, 0])[0]  # First locate block1
-            ind2 = np.where(self.countries_oi == block_list[i, 1])[0]  # Then the second block            
-            
-            if not ((len(ind1) > 0) and (len(ind2) > 0)):  # Jump to next iteration if countries not in countrie_oi
-                continue
-            self.pw_blocksharing[max(ind1[0], ind2[0]), min(ind1[0], ind2[0])].append(float(block_list[i, 3]))  # Add to block sharing.
-            # print("Doing something!!!")
+        nr_blocks = self.fill_blocksharing(ctry1, ctry2, self.blocks['length'])
            
-        print("Interesting block sharing: %.0f " % np.sum([len(a[i, j]) for i in range(k) for j in range(k)]))  # Print interesting block sharing
-        
+        print("Interesting block sharing: %.0f " % nr_blocks)  # Print interesting block sharing
+        
+    def map_to_countries(self, *id_lists):
+        '''Return for every array of individual ids the index in countries_oi of their country.
+        -1 if individual or its country is not of interest. Mappings are built once and joined vectorized'''
+        ctry_index = dict((country, i) for i, country in enumerate(self.countries_oi))
+        ind_ctry = np.array([ctry_index.get(country, -1) for country in self.populations[:, 1]])  # Country index of every individual
+        
+        pop_ids = self.populations[:, 0].astype(np.int64)
+        order = np.argsort(pop_ids)
+        sorted_ids, sorted_ctry = pop_ids[order], ind_ctry[order]
+        
+        ctry_lists = []
+        for ids in id_lists:
+            pos = np.searchsorted(sorted_ids, ids).clip(0, len(sorted_ids) - 1)
+            found = sorted_ids[pos] == ids  # Only known individuals
+            ctry_lists.append(np.where(found, sorted_ctry[pos], -1))
+        return ctry_lists
+    
+    def fill_blocksharing(self, ctry1, ctry2, lengths):
+        '''Append block lengths to pw_blocksharing in a single grouped pass.
+        ctry1, ctry2: country indices of the blocks (-1: not of interest). Return number of added blocks'''
+        k = len(self.countries_oi)
+        keep = (ctry1 >= 0) & (ctry2 >= 0)  # Only countries of interest
+        rows, cols = np.maximum(ctry1[keep], ctry2[keep]), np.minimum(ctry1[keep], ctry2[keep])
+        lengths = lengths[keep]
+        
+        pair_keys = rows * k + cols
+        order = np.argsort(pair_keys, kind='mergesort')  # Stable: Keep order of blocks within pair
+        pair_keys, lengths = pair_keys[order], lengths[order]
+        keys, starts = np.unique(pair_keys, return_index=True)
+        
+        for key, bl_lengths in zip(keys, np.split(lengths, starts[1:])):
+            self.pw_blocksharing[key // k, key % k] += bl_lengths.tolist()  # Add to block sharing.
+        return len(lengths)
 
-    def calculate_pw_dist(self):
+    def calculate_pw_dist(self, visualize=True):
         '''Calculate Pairwise Distances of countries of interest'''
         country_found_list = []  # List of countries which were found
         lat_list = []
@@ -108,26 +134,34 @@ class LoadData(object):
         
         lat1_list = np.array([i[0] for i in lat_list])  # For kml extraction
         long1_list = np.array([i[0] for i in long_list])
-        self.extract_kml(country_found_list, lat1_list, long1_list)
-        
-        self.make_mpl_map(lat1_list, long1_list)  # Send data to Matplot Lib card function
+        if visualize == True:
+            self.extract_kml(country_found_list, lat1_list, long1_list)
+            self.make_mpl_map(lat1_list, long1_list)  # Send data to Matplot Lib card function
         
-        l = len(self.countries_oi) 
-        dist_mat = np.zeros((l, l))
-        for i in range(0, l):  # Iterate over all pairs of 
-            for j in range(0, i): 
-                dist_mat[i, j] = self.calc_dist(lat_list[i], long_list[i], lat_list[j], long_list[j])
-        
-        self.pw_distances = dist_mat
+        self.country_coords = np.column_stack((lat1_list, long1_list))
+        dist_mat = geo_dist.dist_matrix(lat1_list, long1_list)  # All pairs in one vectorized call
+        self.pw_distances = np.tril(dist_mat, -1)  # Only lower triangular matrix is used
         # for i in range(0,l):
             # for j in range(0,i):
                 # print("Distance between %s and %s is: %.1f km" % (self.countries_oi[i],self.countries_oi[j],dist_mat[i,j]/1000))
         
     def calc_dist(self, lat1, long1, lat2, long2):
         '''Calculates the pairwise distance between the given coordinates''' 
+        from geopy.distance import vincenty  # To compute great circle distance from coordinates
         coord1 = (lat1, long1)
         coord2 = (lat2, long2)
         return vincenty(coord1, coord2).meters / 1000.0  # Return distance of input points (in km)
+    
+    def check_pw_dist(self):
+        '''Compare pw_distances to the distances calculated pair by pair with calc_dist.
+        Return the maximum absolute difference (in km)'''
+        max_diff = 0
+        for i in range(len(self.country_coords)):
+            for j in range(i):
+                d = self.calc_dist(self.country_coords[i, 0], self.country_coords[i, 1], self.country_coords[j, 0], self.country_coords[j, 1])
+                max_diff = max(max_diff, abs(d - self.pw_distances[i, j]))
+        print("Maximum difference of distances: %.6f km" % max_diff)
+        return max_diff
 
     
     def calc_ind_nr(self):
@@ -137,11 +171,13 @@ class LoadData(object):
             nr_ind = np.sum(self.populations[:, 1] == country)
             # print("Country %s has %.0f inds" % (country, nr_ind))
             nr_inds.append(nr_ind)
-        self.nr_individuals = nr_inds
+        self.nr_individuals = np.asarray(nr_inds)
                            
     def extract_kml(self, index, lat, lon):
         '''Extract Google maps file from lot long Values with name index'''
+        import simplekml  # To extract Google map files
         kml = simplekml.Kml()  # Load the KML Creater
+        style = kml_style()
     
         for i in range(len(lat)):   
             pnt = kml.newpoint(name=index[i], coords=[(lon[i], lat[i])])   
@@ -156,6 +192,8 @@ class LoadData(object):
         
     def make_mpl_map(self, lats, lons):
         '''Method that makes a map within matplotlib with points at lat, lon'''
+        import matplotlib.pyplot as plt
+        from mpl_toolkits.basemap import Basemap
         
         m = Basemap(projection='merc', llcrnrlat=30, urcrnrlat=65,
                     llcrnrlon=5, urcrnrlon=40, resolution='i')
@@ -179,3 +217,29 @@ class LoadData(object):
             m.plot(x, y, 'bo', markersize=8)
         
         plt.show()
+
+
+def read_ibd_list(ibd_list_path, min_block_length=0, chunk_size=100000, id_cols=(0, 1), len_col=3):
+    '''Reads IBD-list csv (may be gzipped) in chunks of lines directly into typed columns.
+    Only keeps blocks longer than min_block_length, so memory is bounded by chunk size and kept blocks.
+    Only the id and length columns are parsed; the others may hold anything (e.g. chr1).
+    Return structured array with integer fields id1, id2 and float field length'''
+    if ibd_list_path.endswith(".gz"):
+        f = gzip.open(ibd_list_path, "rb")
+    else:
+        f = open(ibd_list_path, "r")
+    
+    f.readline()  # Skip header
+    dtype = [("id1", np.int64), ("id2", np.int64), ("length", float)]
+    
+    chunks = []
+    while True:
+        lines = [line.replace("\"", "") for line in itertools.islice(f, chunk_size)]
+        if not lines: break
+        chunk = np.loadtxt(lines, delimiter=",", usecols=(id_cols[0], id_cols[1], len_col), dtype=dtype, ndmin=1)
+        chunks.append(chunk[chunk['length'] > min_block_length])  # Only keep blocks with minimum length
+    f.close()
+    
+    if not chunks:
+        return np.empty(0, dtype=dtype)
+    return np.concatenate(chunks)
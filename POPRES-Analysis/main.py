@@ -10,14 +10,16 @@ Analysis class contains formulas for the fit (bottom).
 
 
 import cPickle as pickle  # @UnusedImport
-from loaddata import LoadData
+from data_cache import load_data
 from mle_analysis import MLE_analyse
+from individual_data import Individual_Data
 
 # ## Paths to relevant data'''
 folder = "/home/hringbauer/IST/BlockInference/Popres Data/"  # The folder everything can be found in
 pop_path = folder + "ibd-pop-info.csv"  # Population csv path 
 ibd_list_path = folder + "ibd-blocklens.csv"  # IBD-list csv path
 coordinates_path = folder + "country_centroids.csv"  # GPS postion of countries path
+ind_coordinates_path = folder + "ind_coordinates.csv"  # GPS position of every individual (id, lat, long)
 pickle_path = folder + "popres_blocks.p"
 
 # ## Countries to use in mle_analysis:
@@ -34,11 +36,17 @@ print("Welcome back, friend.")
 
 while True:
     inp = input(("\nWhat do you want to do? \n(1) Extract data \n(2) Analyze Data" 
-    "\n(8) Save/Load data \n(0) Exit \n"))
+    "\n(3) Extract individual level data \n(8) Save/Load data \n(0) Exit \n"))
     if inp == 1: 
         min_len = input("What is the minimum block length? (in cM)?\n")
-        data = LoadData(pop_path, ibd_list_path, coordinates_path, min_len, countries_oi)
+        data = load_data(pop_path, ibd_list_path, coordinates_path, min_len, countries_oi, cache_folder=folder)  # Cached if done before
         analysis = MLE_analyse(data, all_chrom=True)      
+        
+    elif inp == 3:
+        min_len = input("What is the minimum block length? (in cM)?\n")
+        ind_data = Individual_Data(ibd_list_path, ind_coordinates_path, min_len)
+        lin_dists, lin_block_sharing, lin_pair_nr = ind_data.give_lin_data(min_len, 150)
+        analysis = MLE_analyse(pw_dist=lin_dists, pw_IBD=lin_block_sharing, pw_nr=lin_pair_nr, all_chrom=True)
     
     elif inp == 2:
         while True:
@@ -58,7 +66,7 @@ while True:
             elif inp1 == 4:
                 while True:
                     inp2 = input("\n(1) Choose MLE-model \n(2) Run Fit\n(3) Bin plot fitted data \n(4) Log-Likelihood surface"
-                            "\n(5) Jack-Knive Countries \n(7) Boots-Trap (Country Pairs) \n(8) Boots-Trap (Blocks)" 
+                            "\n(5) Jack-Knive Countries \n(6) Compare all models \n(7) Boots-Trap (Country Pairs) \n(8) Boots-Trap (Blocks)" 
                             "\n(9) Which times? \n(10) Analyze Residuals \n(11) Plot all fits \n (0) Exit\n")
                     if inp2 == 1:
                         inp3 = input("Which Model?\n(1) Constant \n(2) Doomsday"
@@ -73,6 +81,7 @@ while True:
                     elif inp2 == 3: analysis.plot_fitted_data_error()    
                     elif inp2 == 4: analysis.plot_loglike_surface() 
                     elif inp2 == 5: analysis.jack_knife_ctries() 
+                    elif inp2 == 6: analysis.compare_models()
                     elif inp2 == 7: 
                         bts_nr = input("How many boots traps?\n")
                         analysis.boots_trap_ctry(bts_nr)
@@ -7,16 +7,20 @@ and is saved by pickle
 '''
 
 import numpy as np
-import matplotlib.pyplot as plt
 
 # from mle_estimation import MLE_estimation, MLE_estimation_growth, MLE_estimation_dd Not needed anymore; look in old versions
 from mle_estim_error import MLE_estim_error
+import resampling  # Parallel bootstrap and jack-knife
+import likelihood_grid  # Parallel likelihood surfaces and profiles
+from block_index import Block_Index
+from quadrature_density import Quadrature_Density, constant_demography
 from scipy.stats import binned_statistic  # For calculating binned values for better visualization.
-from statsmodels.stats.moment_helpers import cov2corr
 from scipy.special import kv as kv  # Import Bessel functions of second kind
 from scipy.optimize import curve_fit
 from itertools import izip
 from functools import partial
+from collections import OrderedDict
+import hashlib
 from copy import deepcopy
 
 class MLE_analyse(object):
@@ -45,6 +49,8 @@ class MLE_analyse(object):
     mle_object = 0  # Place for the object used to do MLE.
     error_model = 0  # Default whether to use an error model or not
     all_chrom = 0  # Default whether to use specific human chromosome lenghts
+    pw_bl_index = 0  # Block_Index of the country pairs (order of lin_pair_ctries)
+    lin_bl_index = 0  # Block_Index of lin_block_sharing
     
     def __init__(self, data=0, pw_dist=[], pw_IBD=[], pw_nr=[], all_chrom=False, error_model=True):
         '''
@@ -66,7 +72,8 @@ class MLE_analyse(object):
         self.countries = data.countries_oi
         self.pw_distances = data.pw_distances
         self.pw_block_sharing = data.pw_blocksharing
-        self.nr_individuals = data.nr_individuals 
+        self.nr_individuals = np.asarray(data.nr_individuals)  # Indexed with masks 
+        self.pw_bl_index = 0  # Build new for this data
         self.lin_dists, _ , self.lin_pair_nr, self.labels = self.return_linearized_data(3.0, 150)
         
         
@@ -94,32 +101,46 @@ class MLE_analyse(object):
     def calc_nr_shr_bl(self, threshold, threshold_top=150):
         '''Give back number MATRIX of shared blocks longer than threshold
         and below top threshold (if given). Create self.lin_block_sharing array.'''
-        lin_block_sharing = []  # Delete if existing
-        k = len(self.pw_distances[:, 0])
-        pw_block_nr = np.zeros((k, k))    
-        for i in range(k):
-            for j in range(i):
-                # print(self.pw_block_sharing[i, j])
-                b_s = np.array(self.pw_block_sharing[i, j]).astype('float')
-                pw_block_nr[i, j] = np.sum((b_s >= threshold) * (b_s <= threshold_top))  # Calculate number of interesting blocks
-                lin_block_sharing.append(b_s[(b_s >= threshold) * (b_s <= threshold_top)])  # Keep interesting blocks in linearized array.
+        pw_block_nr = self.calc_nr_shr_mat(threshold, threshold_top)
         self.total_bl_nr = np.sum(pw_block_nr)
         print("Interesting block sharing: %.0f " % self.total_bl_nr)  # Print interesting block sharing
-        self.lin_block_sharing = np.asarray(lin_block_sharing)
+        self.lin_block_sharing = self.get_pw_bl_index().blocks(threshold, threshold_top)  # Keep interesting blocks in linearized array.
         
         return pw_block_nr
     
+    def calc_nr_shr_mat(self, threshold, threshold_top=150):
+        '''Number MATRIX of shared blocks in [threshold, threshold_top]. 
+        Counted from the block index; leaves self.lin_block_sharing unchanged'''
+        k = len(self.pw_distances[:, 0])
+        pw_block_nr = np.zeros((k, k))
+        pairs = self.lin_pair_ctries()
+        pw_block_nr[pairs[:, 0], pairs[:, 1]] = self.get_pw_bl_index().count(threshold, threshold_top)
+        return pw_block_nr
+    
+    def get_pw_bl_index(self):
+        '''Block_Index of the block sharing between countries. Built on first use'''
+        if self.pw_bl_index == 0:
+            k = len(self.pw_distances[:, 0])
+            self.pw_bl_index = Block_Index([self.pw_block_sharing[i, j] for i in range(k) for j in range(i)])
+        return self.pw_bl_index
+    
+    def get_lin_bl_index(self):
+        '''Block_Index of lin_block_sharing. Built new whenever lin_block_sharing was replaced'''
+        if self.lin_bl_index == 0 or self.lin_bl_index.source is not self.lin_block_sharing:
+            self.lin_bl_index = Block_Index(self.lin_block_sharing)
+        return self.lin_bl_index
+    
     def extract_blocks_spec_len(self, min_len, max_len):
         '''Extracts blocks of specific length from linearized array.'''
-        new_block_list = [[b for b in blocks if (min_len < b < max_len)] for blocks in self.lin_block_sharing]
+        new_block_list = self.get_lin_bl_index().blocks(min_len, max_len, strict=True)
         self.total_bl_nr = np.sum([len(b) for b in new_block_list])  # Update the total number of blocks of this length
-        return np.array(new_block_list)
+        return new_block_list
             
     def analyze_bin_ibd(self, min_len, max_len, n_bins=6, show=True):
         '''Extract binned IBD-data of spec. length and return summary statistics
         If bins given use them as distance bins; otherwise only number of bins'''
-        pair_sharing = self.extract_blocks_spec_len(min_len, max_len)
-        pair_sharing = np.array([len(blocks) for blocks in pair_sharing])
+        pair_sharing = self.get_lin_bl_index().count(min_len, max_len, strict=True)
+        self.total_bl_nr = np.sum(pair_sharing)  # Update the total number of blocks of this length
         
         lin_dists, labels, pair_nr = self.lin_dists, self.labels, self.lin_pair_nr
         
@@ -170,6 +191,7 @@ class MLE_analyse(object):
              
     def interactive_plot(self, x, y, labels, size):
         '''Generate interactive scatter plot with click-able labels'''
+        import matplotlib.pyplot as plt
         if 1:  # picking on a scatter plot (matplotlib.collections.RegularPolyCollection)
             def give_country(ind):
                 '''Gives back the country ids from linearized array:'''
@@ -219,6 +241,7 @@ class MLE_analyse(object):
         print("Exact Bessel fit: \nC: %.4G \nr: %.4G" % (C1, r1))
         
         if show == True:  # Do a plot of the fit:
+            import matplotlib.pyplot as plt
             x_plot = np.linspace(min(x), max(x), 10000)
             plt.figure()
             plt.yscale('log')
@@ -245,6 +268,7 @@ class MLE_analyse(object):
         print("Exact Bessel fit: \nC: %.4G \nr: %.4G" % (C1, r1))
             
         if show == True:  # Do a plot of the fit:
+            import matplotlib.pyplot as plt
             x_plot = np.linspace(min(x), max(x), 10000)
             plt.figure()
             plt.title("Interval: " + str(interval) + " cM")
@@ -265,6 +289,7 @@ class MLE_analyse(object):
     
     def visualize_ibd_diff_lengths(self):
         '''This very specific plot method visualizes IBD-sharing '''
+        import matplotlib.pyplot as plt
         f, axarr = plt.subplots(2, 4, sharex=True)  # Create sub-plots
         # intervals = ([3.0, 3.5], [3.5, 4.0], [4.0, 4.5], [4.5, 5], [5.0, 6], [6.0, 7], [7.0, 8.5], [8.5, 10])  # Set the interval-list
         intervals = ([4.0, 4.4], [4.4, 4.9], [4.9, 5.5], [5.5, 6.2], [6.2, 7], [7, 8.4], [8.4, 10], [10, 12])
@@ -309,12 +334,14 @@ class MLE_analyse(object):
         print("C-estimate: " + str(c_est))
         plt.show()
     
-    def create_mle_model(self, model="constant", g=3537.4 * 4, start_param=0):
+    def create_mle_model(self, model="constant", g=3537.4 * 4, start_param=0, bin_counts=None, demography=0):
         '''Create MLE object. Set the model used for MLE
         model: what model to use
         g: genome length in cM -standard is human genome length four diploids
         start_param: What Start Parameters to Use
-        all_chrom: Whether to use the formula for all chromosomes'''
+        all_chrom: Whether to use the formula for all chromosomes
+        bin_counts: Binned blocks of an earlier MLE object on the same data (not binned again)
+        demography: For model "general": Population density history D(t, params) (see quadrature_density)'''
 
         if model == "constant":
             bl_shr_density = uniform_density
@@ -331,6 +358,9 @@ class MLE_analyse(object):
         elif model == "ddd":
             bl_shr_density = powergrowth_density_dd
             start_params = [0.001530, 60, 1, 0]
+        elif model == "general":  # Numerical integration over the demography
+            bl_shr_density = Quadrature_Density(demography if demography else constant_demography)
+            start_params = [0.01, 70]
         else: 
             print("No suitable function found")
             
@@ -343,7 +373,9 @@ class MLE_analyse(object):
              152.45, 171.09, 128.6, 118.49, 128.76, 128.86, 135.04, 120.59, 109.73, 98.35, 61.9, 65.86])  # All human chromosome lengths
         # gss = np.array([3537.4, ])  # For testing
         
-        if self.all_chrom:  # Do the sum for multiple chromosomes. 
+        if self.all_chrom and model == "general":  # Sums over the chromosomes itself
+            bl_shr_density.gs = gss / 100.0
+        elif self.all_chrom:  # Do the sum for multiple chromosomes. 
             temp_dens = partial(all_chromosomes, gs=gss / 100.0)  
             bl_shr_density = partial(temp_dens, bl_density=bl_shr_density)  # Fix function
         
@@ -351,15 +383,18 @@ class MLE_analyse(object):
         
         if start_param:  # In case start params are given override
             start_params = start_param
+        density_derivs = model in ("constant", "doomsday", "power_growth")  # Densities with analytic derivatives
         # Create MLE_estimation object. First endogenous Second exogenous Variables:
         self.mle_object = MLE_estim_error(bl_shr_density, start_params, self.lin_dists,
-                                          self.lin_block_sharing, self.lin_pair_nr, error_model=self.error_model) 
+                                          self.lin_block_sharing, self.lin_pair_nr, error_model=self.error_model,
+                                          bin_counts=bin_counts, density_derivs=density_derivs) 
         self.estimates = start_params  # Best guess without doing anything. Used as start for Bootstrap
     
     
     def mle_analysis_error(self):
         '''Does a maximum likelihood analysis with the full error model. Parameters can be found there
         Param[0] always C; Param[1] always sigma'''
+        from statsmodels.stats.moment_helpers import cov2corr
         ml_estimator = self.mle_object 
         print("Doing fit...")
         results = ml_estimator.fit()  # method="nelder-mead"
@@ -380,8 +415,49 @@ class MLE_analyse(object):
         print(results.summary())  # Give out the results.
         self.mle_object = ml_estimator  # Remember the mle-estimation object.
         
+    def compare_models(self, g=3537.4 * 4, start_param=0):
+        '''Fit all models; a richer model starts at the optimum of the model nested in it.
+        constant and doomsday (not nested in each other; both from their default start) are the
+        special cases beta=0 and beta=1 of power_growth, which starts from the better of the two;
+        ddd (T=0: power_growth); exp_const (E=0: constant). The binned data and the transition matrix are shared.
+        start_param: Start parameters of the constant model. Print and return table of 
+        (model, estimates, log likelihood, AIC). The MLE object with the best AIC is kept'''
+        fits = OrderedDict()  # Model: (Estimates, log likelihood, MLE object)
+        
+        def fit_model(model, start_params):
+            bin_counts = fits["constant"][2].bin_counts if "constant" in fits else None  # Bin the blocks only once
+            self.create_mle_model(model, g, start_params, bin_counts=bin_counts)
+            results = self.mle_object.fit()
+            fits[model] = (results.params, results.llf, self.mle_object)
+            print("Fitted %s: Log likelihood: %.4f" % (model, results.llf))
+        
+        fit_model("constant", start_param)
+        D, sigma = fits["constant"][0][:2]
+        fit_model("doomsday", 0)  # Other scale of D; so its own default start
+        if fits["constant"][1] >= fits["doomsday"][1]:  # Start from the better of the two special cases
+            start_params = [D, sigma, 0]
+        else:
+            start_params = list(fits["doomsday"][0][:2]) + [1]
+        fit_model("power_growth", start_params)
+        fit_model("ddd", list(fits["power_growth"][0]) + [0])
+        fit_model("exp_const", [D, sigma, 0.2, 0])
+        
+        table = []
+        print("\nModel           Log likelihood     AIC          Estimates")
+        for model, (params, llf, _) in fits.items():
+            aic = 2 * len(params) - 2 * llf
+            table.append((model, params, llf, aic))
+            print("%-15s %-18.4f %-12.4f %s" % (model, llf, aic, params))
+        
+        best = min(table, key=lambda row: row[3])
+        print("Best model (AIC): %s" % best[0])
+        self.mle_object = fits[best[0]][2]
+        self.estimates = best[1]
+        return table
+        
     def plot_fitted_data_error(self):
         '''Plot fit of full model to binned data set.'''
+        import matplotlib.pyplot as plt
         f, axarr = plt.subplots(2, 2, sharex=True)  # Create sub-plots
         # intervals = ([3.0, 3.3], [3.3, 3.7], [3.7, 4.2], [4.2, 4.8], [4.8, 5.5], [5.5, 6.5], [6.5, 8], [8, 10])  # Set the interval-list
         # intervals = ([4, 4.5], [4.5, 5.2], [5.2, 6.5], [6.5, 8], [8, 10], [10, 12], [12, 14], [14, 18])  # Set the interval-list
@@ -418,6 +494,7 @@ class MLE_analyse(object):
         
     def plot_allin_one(self):
         '''Plot function to empirically plot best estimates for binned data in one window'''
+        import matplotlib.pyplot as plt
         # intervals = ([3.0, 3.3], [3.3, 3.7], [3.7, 4.2], [4.2, 4.8], [4.8, 5.5], [5.5, 6.5], [6.5, 8], [8, 10])  # Set the interval-list
         # intervals = ([4, 4.5], [4.5, 5.2], [5.2, 6.5], [6.5, 8], [8, 10], [10, 12], [12, 14], [14, 18])  # Set the interval-list
         # intervals = ([4.0, 4.4], [4.4, 4.9], [4.9, 5.5], [5.5, 6.2], [6.2, 7], [7, 8.4], [8.4, 10], [10, 12])  # Set the interval-list
@@ -477,79 +554,54 @@ class MLE_analyse(object):
 
         return([cons, dd, pg])
     
-    def boots_trap_ctry(self, nr=100):
-        '''Does a bootstrap with nr run over countries pairs'''
-        bl_shr_density = self.mle_object.density_fun  # Extract the last used block-sharing function
+    def boots_trap_ctry(self, nr=100, processes=None, save_path=None):
+        '''Does a bootstrap with nr run over countries pairs. Runs in parallel;
+        finished fits are appended to save_path (if given)'''
         start_params = self.estimates  # Extract the last inferred parameters                    
-        res = []  # Vector for bootstrap estimates
-        lin_shr, lin_d, lin_nr = self.lin_block_sharing, self.lin_dists, self.lin_pair_nr
-        
-        for _ in range(nr):
-            r_ind = np.random.randint(len(lin_d), size=len(lin_d))  # Get random resampling
-            ml_est_temp = MLE_estim_error(bl_shr_density, start_params, lin_d[r_ind],
-                                          lin_shr[r_ind], lin_nr[r_ind], error_model=self.error_model) 
-            temp_results = ml_est_temp.fit()  
-            res.append(temp_results.params)
-        res = np.array(res)
+        res = resampling.run_replicates(self.mle_object, "pairs", nr, start_params, save_path=save_path, processes=processes)
         self.btst_estimates = res  # Save the results
         self.analyse_bts_results(res)  # Analyse the results-vector
     
-    def boot_trap_blocks(self, nr=10):
-        '''Do a boots trap over all block pairs. Resample all blocks; first multinomial per pop-per and
-        then within population. Nr: Number of boots-trap runs. Save results to analysis-object'''
-        bl_shr_density = self.mle_object.density_fun  # Extract the last used block-sharing function
-        
-        # block_l, block_u = self.mle_object.min_len, self.mle_object.max_len
+    def boot_trap_blocks(self, nr=10, processes=None, save_path=None, mode="poisson"):
+        '''Do a boots trap over all block pairs. Resample all blocks; first Poisson number per pop-pair and
+        then within population. Nr: Number of boots-trap runs. Save results to analysis-object.
+        mode: "poisson" resample the binned block counts (same distribution; no block lists are built),
+        "multinomial" keep the total number of blocks fixed, "lists" resample the block lists.
+        Runs in parallel; finished fits are appended to save_path (if given)'''
+        kind = {"poisson": "block_counts", "multinomial": "block_counts_multinomial", "lists": "blocks"}[mode]
         start_params = self.estimates  # Extract the last inferred parameters (to have a good start)
-        res = []  # Vector for bootstrap estimates
-        
-        # (linear_dist, _, pair_nr, _) = self.return_linearized_data(block_l, block_u)  # First linearize the data as usual
-        # exog = np.column_stack((linear_dist, pair_nr))  # Stack the exogenous variables together
-        
-        len_list = np.array([len(i) for i in self.lin_block_sharing]).astype(np.float)  # Nr of shared blocks per Ctry pair
-        # nr_pairs = float(np.sum(len_list))  # How many pairs in total
-        
-        
-        # Temporally add blocks to empty lists (only here) so that in np.choice no bugs occurs
-        lin_bls = [b_list if (len(b_list) > 0) else np.array([1, ]) for b_list in self.lin_block_sharing]
-        
-        for i in range(nr):  # Do the bootstrap runs
-            # Create the random resampling:
-            # First: Number of new blocks per Ctr-pair:
-            bt_list = np.array([np.random.poisson(nr) for nr in len_list])
-            # bt_list = np.random.multinomial(nr_pairs, len_list / nr_pairs)  # Resample nr shrd per ctry pair
-            lin_bs = [np.random.choice(lin_bls[j], bt_list[j]) for j in range(len(len_list))]  # Within country resample
-            lin_bs = np.array(lin_bs)
-            ml_estimator_temp = MLE_estim_error(bl_shr_density, start_params, self.lin_dists,
-                                                lin_bs, self.lin_pair_nr, error_model=self.error_model) 
-            temp_results = ml_estimator_temp.fit()  
-            res.append(temp_results.params)
-        res = np.array(res)
+        res = resampling.run_replicates(self.mle_object, kind, nr, start_params, save_path=save_path, processes=processes)
         self.btst_estimates = res  # Save the results
         self.analyse_bts_results(res)  # Analyse the results-vector    
         
-    def plot_loglike_surface(self, nr_intervals=15, params=0):
+    def plot_loglike_surface(self, nr_intervals=15, params=0, inds=(0, 1), profile=False, processes=None):
         '''Creates a likelihood surface for list of param. 
         rows: parameters 2 columns: upper and lower limit
         nr_intervals: Number of intervals
-        If not paramst given take 7 estimated stds'''
+        If not paramst given take 7 estimated stds
+        inds: The two parameters of the surface. Others are fixed to the estimates,
+        or maximized over if profile. Evaluated in parallel (see likelihood_grid)'''
+        import matplotlib.pyplot as plt
+        i0, i1 = inds
         if params == 0:
-            params0 = self.estimates[0] - 7 * self.stds[0], self.estimates[0] + 7 * self.stds[0]
-            params1 = self.estimates[1] - 7 * self.stds[1], self.estimates[1] + 7 * self.stds[1]
+            params0 = self.estimates[i0] - 7 * self.stds[i0], self.estimates[i0] + 7 * self.stds[i0]
+            params1 = self.estimates[i1] - 7 * self.stds[i1], self.estimates[i1] + 7 * self.stds[i1]
             params = [params0, params1]
         params = np.array(params)
         x_vec = np.linspace(params[0, 0], params[0, 1], nr_intervals)
         y_vec = np.linspace(params[1, 0], params[1, 1], nr_intervals)
         xv, yv = np.meshgrid(x_vec, y_vec)
-        xt, yt = xv.flatten(), yv.flatten()  # Linearize for list generation
         
-        z = [self.mle_object.loglike([xt[i], yt[i]]) for i in range(len(xt))]  # Calc Log Likelihoods
-        z = np.ceil(z)  # Round up for better plotting   
+        if profile == True:
+            z, _ = likelihood_grid.profile_surface(self.mle_object, self.estimates, inds, x_vec, y_vec, processes)
+        else:
+            z = likelihood_grid.loglike_surface(self.mle_object, self.estimates, inds, x_vec, y_vec, processes)  # Calc Log Likelihoods
+        z = np.ceil(z.flatten())  # Round up for better plotting   
         levels = np.arange(max(z) - 30, max(z) + 1, 2)  # Every two likelihood units
         
         plt.figure()
         ax = plt.contourf(xv, yv, z.reshape((nr_intervals, nr_intervals)), levels=levels, alpha=0.8)
-        plt.plot(self.estimates[0], self.estimates[1], 'ko')
+        plt.plot(self.estimates[i0], self.estimates[i1], 'ko')
         
         # plt.clabel(ax, inline=1, fontsize=10)
         plt.colorbar(ax, format="%i")
@@ -558,38 +610,18 @@ class MLE_analyse(object):
         plt.ylabel(r"$\sigma$", fontsize=20)
         
         if len(self.btst_estimates) > 0:  # In case there are bootstrap results plot them.
-            plt.scatter(self.btst_estimates[:, 0], self.btst_estimates[:, 1], marker='x')    
+            plt.scatter(self.btst_estimates[:, i0], self.btst_estimates[:, i1], marker='x')    
         plt.show()
         
-    def jack_knife_ctries(self):
+    def jack_knife_ctries(self, processes=None, save_path=None):
         '''Fit model without certain countries; and predict their residuals
-        Basically do a jack-knive'''
-        # Copy the relevant original data - we dont want to overwrite it
-        pw_distances, pw_block_sharing = np.copy(self.pw_distances), np.copy(self.pw_block_sharing)
-        nr_individuals = np.copy(self.nr_individuals)
-        
-        # Extract relevant info from the MLE-object
-        bl_shr_density = self.mle_object.density_fun  # Extract the last used block-sharing function
+        Basically do a jack-knive. The fits run in parallel on the
+        observations of the last MLE-object which do not involve the country'''
         start_params = self.estimates  # Extract the last inferred parameters  
-        res = []  # Vector for the Jack-Knive estimates
-                          
-        for i in range(len(self.countries)):  # Iterate over all countries
-            # Delete rows and columns associated to that raw. Use adv. indexing:
-            indices = np.array([1 if j != i else 0 for j in range(len(nr_individuals))]).astype("bool")   
-            self.nr_individuals = nr_individuals[indices]
-            self.pw_distances = pw_distances[:, indices][indices, :]
-            self.pw_block_sharing = pw_block_sharing[indices, :][:, indices]
-            
-            # First linearize the data as usual. This updates self.lin_block_sharing
-            (linear_dist, _, pair_nr, _) = self.return_linearized_data(3.0, 150.0)  
-            ml_estimator_temp = MLE_estim_error(bl_shr_density, start_params, linear_dist,
-                                                self.lin_block_sharing, pair_nr, error_model=self.error_model) 
-            temp_results = ml_estimator_temp.fit()  
-            res.append(temp_results.params)
-        res = np.array(res)
-        # Restore original values:
-        self.pw_distances, self.pw_block_sharing = pw_distances, pw_block_sharing
-        self.nr_individuals = nr_individuals
+        pair_ctries = self.lin_pair_ctries()
+        masks = [(pair_ctries[:, 0] != i) & (pair_ctries[:, 1] != i) for i in range(len(self.countries))]
+        res = resampling.run_replicates(self.mle_object, "jackknife", len(masks), start_params, save_path=save_path,
+                                        processes=processes, masks=masks)
         
         self.btst_estimates = res  # Save the results
         self.analyse_bts_results(res)  # Analyse the results-vector
@@ -597,6 +629,11 @@ class MLE_analyse(object):
         print(np.column_stack((self.countries, res)))  # Give out results per country
         
         self.get_country_residuals()
+    
+    def lin_pair_ctries(self):
+        '''Country indices (i, j) of every entry of the linearized data (same order as return_linearized_data)'''
+        k = len(self.countries)
+        return np.array([(i, j) for i in range(k) for j in range(i)]).reshape((-1, 2))
        
     def get_country_residuals(self):
         '''Get the residuals for a county. Needs run of Jack-Knife (typically called from there)'''
@@ -604,7 +641,7 @@ class MLE_analyse(object):
                 
         pw_distances = self.pw_distances  # Load full pairwise distance Matrix
         # Get empirical block sharing matrix for every interval
-        pw_bl_shr = [self.calc_nr_shr_bl(i[0], i[1]) for i in intervals] 
+        pw_bl_shr = [self.calc_nr_shr_mat(i[0], i[1]) for i in intervals] 
         
         results_pred = []  # Vector for the results
         results_emp = []
@@ -615,11 +652,9 @@ class MLE_analyse(object):
             pw_dists = pw_distances[i, indices] + pw_distances[indices, i]  # Distances to other countries
             pw_bl_shr_prune = [np.sum(k[i, indices] + k[indices, i]) for k in pw_bl_shr]  # Get empirical block sharing
             
-            # Calculate the estimated block-sharing with every other country:
-            blocks_thr = []
-            for interval in intervals:
-                bs_pp = self.mle_object.get_bl_shr_interval(interval, pw_dists, params) 
-                blocks_thr.append(np.sum(nr_pairs * bs_pp))  # Multiply pp-sharing by number of pairs
+            # Calculate the estimated block-sharing with every other country (for all intervals at once):
+            bs_pp = self.mle_object.get_bl_shr_tensor(intervals, pw_dists, params)
+            blocks_thr = np.sum(nr_pairs[:, None] * bs_pp, axis=0)  # Multiply pp-sharing by number of pairs
             results_pred.append(blocks_thr)
             results_emp.append(pw_bl_shr_prune)
             
@@ -634,6 +669,7 @@ class MLE_analyse(object):
     
     def visualize_residuals(self, res_th, res_emp, countries):
         '''Method for visualizing the residuals'''
+        import matplotlib.pyplot as plt
         k = len(countries)
         x_base = np.array([7 * i for i in range(k)])  # Basis X-value
         w = 1  # Bar width
@@ -655,28 +691,29 @@ class MLE_analyse(object):
         plt.grid()
         plt.show()
     
-    def calculate_pw_residuals(self, intervals=0, params=0):
-        '''Analyze the residual-matrix for pairs of countries'''
+    def calculate_pw_residuals(self, intervals=0, params=0, verbose=False):
+        '''Analyze the residual-matrix for pairs of countries.
+        verbose: Print expected and actual sharing for every pair'''
         if intervals == 0: intervals = [[4.0, 6.0], [6.0, 8.0], [8.0, 12.0]]  # Default Values
         if params == 0: params = self.estimates
         ctrs = self.countries  # Load the country list
         k = len(ctrs)  # Get the total number of countries
         
         pw_dist = self.pw_distances  # PW Distances
-        pw_bl_shr = [self.calc_nr_shr_bl(i[0], i[1]) for i in intervals]  # Calc. emp. block-shr matrices
+        pw_bl_shr = [self.calc_nr_shr_mat(i[0], i[1]) for i in intervals]  # Calc. emp. block-shr matrices
         # Get Matrix of pairwise individuals
         ind_mat = np.array([[i * j for j in self.nr_individuals] for i in self.nr_individuals])
-        emp_shr, th_shr = np.zeros((k, k, 3)), np.zeros((k, k, 3))  # Create-block sharing matrices  
+        emp_shr, th_shr = np.zeros((k, k, len(intervals))), np.zeros((k, k, len(intervals)))  # Create-block sharing matrices  
         
-        for i in range(k):  # Loop over all pairwise countries
-            for j in range(i):                  
-                for l in range(len(intervals)):  # Loop over the intervals
-                    interval = intervals[l]
-                    emp_shr[i, j, l] = pw_bl_shr[l][i, j]  # Record empirical block-sharing
-                    
-                    # Get theoretical pairwise block sharing
-                    bs_pp = self.mle_object.get_bl_shr_interval(interval, [pw_dist[i, j], ], params) 
-                    th_shr[i, j, l] = (ind_mat[i, j] * bs_pp)  # Multiply pp-sharing by number of pairs
+        ii, jj = np.tril_indices(k, -1)  # All pairwise countries
+        emp_shr[ii, jj] = np.column_stack([bl_shr[ii, jj] for bl_shr in pw_bl_shr])  # Record empirical block-sharing
+        # Get theoretical pairwise block sharing for all pairs and intervals at once
+        bs_pp = self.mle_object.get_bl_shr_tensor(intervals, pw_dist[ii, jj], params)
+        th_shr[ii, jj] = ind_mat[ii, jj][:, None] * bs_pp  # Multiply pp-sharing by number of pairs
+        
+        if verbose == True:
+            for i, j in zip(ii, jj):
+                for l in range(len(intervals)):
                     print("Block Shr %s - Block Shr %s" % (ctrs[i], ctrs[j]))
                     print("Expected: %.4f Actual: %i" % (th_shr[i, j, l], emp_shr[i, j, l]))
                     
@@ -685,6 +722,7 @@ class MLE_analyse(object):
             
     def plot_pw_residuals(self, thr_mat, emp_mat, interval, ctrs):
         '''Method for plotting the pairwise residuals'''
+        import matplotlib.pyplot as plt
         k = len(ctrs)
         il1 = np.tril_indices(k, k=-1)  # Indices of lower triangular matrix
         ctrs = ["AT", "HU", "CZ", "SK", "SL", "PL", "RO", "BG", "MK", "BA", "HR", "RS", "ME", "AL"]
@@ -783,15 +821,76 @@ def bessel_decay2(x, C, r):
     '''Fit to expected decay of certain block length C absolute Value, r rate of decay'''
     return(C * x * x * kv(2, r * x)) 
 
+kv_cache = OrderedDict()  # Least recently used cache of Bessel function values
+kv_cache_bytes = 2 ** 27  # Maximum total size of the cached values (128 MB)
+kv_cache_stats = {"hits": 0, "misses": 0, "bytes": 0}  # Cache hits, misses and current size
+
+def cached_kv(order, l, r, sigma):
+    '''Bessel function kv(order, sqrt(2l) r / sigma) for arrays l (Morgan) and r. 
+    Cached (LRU, capped by the total size) by order, sigma and the arrays l and r; these are
+    the bin grid and the distances of a batch, so the key is cheap. The Bessel argument itself is never hashed.
+    Return read only array'''
+    l, r = np.asarray(l, dtype=float), np.asarray(r, dtype=float)
+    key = (float(order), float(sigma), l.shape, r.shape, hashlib.md5(l.tobytes() + r.tobytes()).hexdigest())
+    if key in kv_cache:
+        kv_cache_stats["hits"] += 1
+        value = kv_cache.pop(key)  # Re-inserted below as most recently used
+        kv_cache[key] = value
+        return value
+    
+    kv_cache_stats["misses"] += 1
+    value = np.asarray(kv(order, np.sqrt(2.0 * l) * r / sigma))
+    value.flags.writeable = False
+    if value.nbytes <= kv_cache_bytes:
+        while kv_cache_stats["bytes"] + value.nbytes > kv_cache_bytes:
+            kv_cache_stats["bytes"] -= kv_cache.popitem(last=False)[1].nbytes  # Remove least recently used
+        kv_cache[key] = value
+        kv_cache_stats["bytes"] += value.nbytes
+    return value
+
 def bd_basis(l, r, D, sigma, b):
     '''Bessel decay for power growth model and G=1
     Central Ingredient for further calculations. Return density per cM'''
     C = 2 ** (-3 - 3 * b / 2.0) / (np.pi * sigma ** 2 * D)  # The constant in front
 
-    b_l = C * (r / (np.sqrt(l) * sigma)) ** (2 + b) * kv(2 + b,
-    np.sqrt(2.0 * l) * r / sigma)
+    b_l = C * (r / (np.sqrt(l) * sigma)) ** (2 + b) * cached_kv(2 + b, l, r, sigma)
     return b_l / 100.0  # Factor for density in centi Morgan
 
+def bd_basis_derivs(l, r, D, sigma, b):
+    '''bd_basis and its analytic derivatives in D and sigma. With nu=2+b and z=sqrt(2l)r/sigma
+    bd_basis is prop. to sigma^-2 z^nu K_nu(z); uses d/dz[z^nu K_nu(z)] = -z^nu K_(nu-1)(z).
+    Return value, gradient (2,...) and Hessian (2,2,...)'''
+    nu = 2 + b
+    z = np.sqrt(2.0 * l) * r / sigma
+    k0, k1, k2 = cached_kv(nu, l, r, sigma), cached_kv(nu - 1, l, r, sigma), cached_kv(nu - 2, l, r, sigma)
+    C = 2 ** (-3 - 3 * b / 2.0) / (np.pi * sigma ** 2 * D)  # The constant in front
+    base = C * (r / (np.sqrt(l) * sigma)) ** nu / 100.0  # Everything but the Bessel function
+    
+    f = base * k0
+    f_s = base / sigma * (-2 * k0 + z * k1)
+    f_ss = base / sigma ** 2 * (6 * k0 - 7 * z * k1 + z ** 2 * k2)
+    grad = np.array([-f / D, f_s])
+    hess = np.array([[2 * f / D ** 2, -f_s / D], [-f_s / D, f_ss]])
+    return f, grad, hess
+
+def bd_basis_derivs_beta(l, r, D, sigma, b, h=1e-4):
+    '''bd_basis_derivs with the growth parameter b as third parameter. There is no closed form
+    for the derivative of kv in its order; so for b central differences with step h are used'''
+    f, grad, hess = bd_basis_derivs(l, r, D, sigma, b)
+    f_p, grad_p, _ = bd_basis_derivs(l, r, D, sigma, b + h)
+    f_m, grad_m, _ = bd_basis_derivs(l, r, D, sigma, b - h)
+    cross = (grad_p - grad_m) / (2 * h)  # Mixed derivatives with D, sigma
+    
+    grad3 = np.concatenate((grad, [(f_p - f_m) / (2 * h)]))
+    hess3 = np.empty((3, 3) + f.shape)
+    hess3[:2, :2], hess3[:2, 2], hess3[2, :2] = hess, cross, cross
+    hess3[2, 2] = (f_p - 2 * f + f_m) / h ** 2
+    return f, grad3, hess3
+
+def edge_terms_derivs(w, terms, terms1):
+    '''w * terms + terms1 for (value, gradient, Hessian) tuples. For chromosomal edge effects'''
+    return tuple(w * t + t1 for t, t1 in zip(terms, terms1))
+
 def bessel_decay_interval(r, C, sigma, interval, mu=0):
     '''Gives Bessel-Decay in a given interval If r vector returns vector'''
     l = 2.0 / (1.0 / interval[0] + 1.0 / interval[1])  # Calculate Harmonic Mean
@@ -807,47 +906,75 @@ def dd_decay_interval(r, C, sigma, interval):
     return b_l * (interval[1] - interval[0]) / 100.0
 
     
-def uniform_density(l, r, params, g):
+def uniform_terms(l, r, params, deriv=False):
+    '''Bessel terms (A, B) of the uniform density (G - l) * A + B; l in Morgan.
+    deriv: Every term as value, gradient and Hessian'''
+    basis = bd_basis_derivs if deriv else bd_basis
+    return basis(l, r, params[0], params[1], 0), basis(l, r, params[0], params[1], -1)
+
+def dd_terms(l, r, params, deriv=False):
+    '''Bessel terms (A, B) of the Doomsday density (G - l) * A + B; l in Morgan'''
+    basis = bd_basis_derivs if deriv else bd_basis
+    return basis(l, r, params[0], params[1], 1), basis(l, r, params[0], params[1], 0)
+
+def powergrowth_terms(l, r, params, deriv=False):
+    '''Bessel terms (A, B) of the Powergrowth density (G - l) * A + B; l in Morgan'''
+    basis = bd_basis_derivs_beta if deriv else bd_basis
+    beta = params[2]
+    return basis(l, r, params[0], params[1], beta), basis(l, r, params[0], params[1], beta - 1)
+
+def edge_density(w, terms, deriv=False):
+    '''Combine the Bessel terms (A, B) with the edge weight w: w * A + B'''
+    if deriv:
+        return edge_terms_derivs(w, terms[0], terms[1])
+    return w * terms[0] + terms[1]
+
+def uniform_density(l, r, params, g, deriv=False):
     '''Gives uniform density per cM(!) If l vector return vector.
-    Includes chromosomal edge effects'''
+    Includes chromosomal edge effects. deriv: Return value, gradient and Hessian'''
     l = l / 100.0  # Switch to Morgan
     G = g  # 35.374 for human data
-    D = params[0]
-    sigma = params[1]
-     
-    b_l = (G - l) * bd_basis(l, r, D, sigma, 0) + bd_basis(l, r, D, sigma, -1)
-    return b_l
+    return edge_density(G - l, uniform_terms(l, r, params, deriv), deriv)
 
-def dd_density(l, r, params, g):
+def dd_density(l, r, params, g, deriv=False):
     '''Gives the Doomsday density per cM(!) If l vector return vector
-    Includes chromosomal edge effects'''
+    Includes chromosomal edge effects. deriv: Return value, gradient and Hessian'''
     l = l / 100.0  # Switch to Morgan
     G = g  # 35.374 for human data
-    D = params[0]
-    sigma = params[1]
-     
-    b_l = (G - l) * bd_basis(l, r, D, sigma, 1) + bd_basis(l, r, D, sigma, 0)
-    return b_l
+    return edge_density(G - l, dd_terms(l, r, params, deriv), deriv)
 
-def powergrowth_density(l, r, params, g):
+def powergrowth_density(l, r, params, g, deriv=False):
     '''Gives the Powergrowth density of block sharing per cM(!) If l vector return vector
-    Includes chromosomal edge effects'''
+    Includes chromosomal edge effects. deriv: Return value, gradient and Hessian'''
     l = l / 100.0  # Switch to Morgan
     G = g  # 35.374 for human data
-    D = params[0]
-    sigma = params[1]
-    beta = params[2]
-     
-    b_l = (G - l) * bd_basis(l, r, D, sigma, beta) + bd_basis(l, r, D, sigma, beta - 1)
-    return b_l
+    return edge_density(G - l, powergrowth_terms(l, r, params, deriv), deriv)
 
-def all_chromosomes(l, r, params, bl_density, gs):
+density_terms = {uniform_density: uniform_terms, dd_density: dd_terms,
+                 powergrowth_density: powergrowth_terms}  # Bessel terms of the densities of the form (G - l) * A + B
+
+def all_chromosomes(l, r, params, bl_density, gs, deriv=False):
     '''Gives density per cM(!) over all chromosomes in gs. 
     Assumes diploids (that's the factor four)
     If r vector - returns vector
+    deriv: Return value, gradient and Hessian (bl_density has to support deriv)
     '''
-    res = 4.0 * np.sum([bl_density(l, r, params, gi) for gi in gs], axis=0)  # Sum over all chromosomes
-    # Problem np.sum initially summed over r; but only need to sum over gi! SOLVED
+    l, r = np.asarray(l, dtype=float), np.asarray(r, dtype=float)
+    gs = np.asarray(gs, dtype=float)
+    if bl_density in density_terms:  # Bessel terms once for all chromosomes:
+        l_m = l / 100.0  # Switch to Morgan
+        A, B = density_terms[bl_density](l_m, r, params, deriv)
+        w = np.sum(gs) - len(gs) * l_m  # Sum of (G - l) over all chromosomes
+        B = tuple(len(gs) * t for t in B) if deriv else len(gs) * B
+        res = edge_density(w, (A, B), deriv)
+        return tuple(4.0 * t for t in res) if deriv else 4.0 * res
+    if deriv:  # Summed up chromosome by chromosome to save memory
+        res = bl_density(l, r, params, gs[0], deriv=True)
+        for gi in gs[1:]:
+            res = [t + t1 for t, t1 in zip(res, bl_density(l, r, params, gi, deriv=True))]
+        return tuple(4.0 * t for t in res)
+    # All chromosomes in one broadcast call along a new last axis; kv is evaluated once for all of them:
+    res = 4.0 * np.sum(bl_density(l[..., None], r[..., None], params, gs), axis=-1)  # Sum over all chromosomes
     return(res)
 
 # Original powergrowth density
@@ -898,23 +1025,34 @@ def powergrowth_density_t_l0(l0, r, t, params, g):
     return b_l
     
 def exp_con_density(l, r, params, g):
-    '''Gives density for hyperexponential-constant growth mix. (per cM) If l vector return vector''' 
+    '''Gives density for hyperexponential-constant growth mix. (per cM) If l vector return vector
+    E=0 is the constant model. (Until Oct 2026 E was a second density; see params_from_old)''' 
     D = params[0]
     sigma = params[1]
     mu = params[2]
-    E = params[3]  # Second constant
-    C = g / (4 * np.pi * sigma ** 2 * D)  # The constant in front
-    return uniform_density(l, r, [C, sigma]) - uniform_density(l + mu / 2.0, r, [E, sigma])  # Reduce it to uniform case
+    E = params[3]  # Multiplier of the second term
+    return uniform_density(l, r, [D, sigma], g) - E * uniform_density(l + mu / 2.0, r, [D, sigma], g)  # Reduce it to uniform case
 
 def powergrowth_density_dd(l, r, params, g):
-    '''Gives a powergrowth with a dooms day'''
+    '''Gives a powergrowth with a dooms day. T=0 is the powergrowth model.
+    (Until Oct 2026 T multiplied the density of the second term; see params_from_old)'''
     D = params[0]
     sigma = params[1]
     b = params[2]
-    T = params[3]
-    C = g / (4 * np.pi * sigma ** 2 * D)  # The constant in front
-    return powergrowth_density(l, r, [C , sigma, b]) + uniform_density(l, r, [T * C, sigma])
+    T = params[3]  # Multiplier of the constant term
+    return powergrowth_density(l, r, [D, sigma, b], g) + T * uniform_density(l, r, [D, sigma], g)
 
+def params_from_old(model, params, g):
+    '''Map parameters of the old parameterisation of exp_const and ddd to the current one (for one chromosome g).
+    Old: C = g / (4 pi sigma^2 D) was the density of the first term; the second term had density E (exp_const)
+    or T * C (ddd). The uniform density is proportional to 1 / D; so: D -> C, E -> C / E, T -> 1 / T'''
+    D, sigma, x, y = params
+    C = g / (4 * np.pi * sigma ** 2 * D)
+    if model == "exp_const":
+        return [C, sigma, x, C / y]
+    elif model == "ddd":
+        return [C, sigma, x, 1.0 / y]
+    raise ValueError("No old parameterisation for %s" % model)
 
 # def from_C_to_D_e(C, sigma):
 #   '''Calculates the actual density from C and sigma'''
@@ -925,3 +1063,48 @@ def powergrowth_density_dd(l, r, params, g):
     
 
         
+
+
+######################### Some lines to test the code
+def check_params_from_old(g=1.5):
+    '''The old and current parameterisations of exp_const and ddd give the same density at mapped parameters'''
+    l, r = np.linspace(4, 20, 30)[None, :], np.linspace(50, 1500, 20)[:, None]
+
+    def exp_con_old(params):
+        D, sigma, mu, E = params
+        C = g / (4 * np.pi * sigma ** 2 * D)
+        return uniform_density(l, r, [C, sigma], g) - uniform_density(l + mu / 2.0, r, [E, sigma], g)
+
+    def ddd_old(params):
+        D, sigma, b, T = params
+        C = g / (4 * np.pi * sigma ** 2 * D)
+        return powergrowth_density(l, r, [C, sigma, b], g) + uniform_density(l, r, [T * C, sigma], g)
+
+    for model, old, new, params in [("exp_const", exp_con_old, exp_con_density, [0.02, 60, 0.2, 0.01]),
+                                    ("ddd", ddd_old, powergrowth_density_dd, [0.002, 60, 1, 0.5])]:
+        ratio = new(l, r, params_from_old(model, params, g), g) / old(params)
+        print("%s: Maximum relative difference %.2e" % (model, np.max(np.abs(ratio - 1))))
+        assert np.all(np.abs(ratio - 1) < 1e-10)
+
+
+def check_kv_cache():
+    '''Repeated log likelihood evaluations at the same sigma take all Bessel values from the cache;
+    the cache stays below its size limit'''
+    from resampling import simulated_model
+    model = simulated_model()
+    model.verbose = False
+    model.loglike([0.01, 70])
+    model.score([0.01, 70])  # Also the Bessel functions of the derivatives
+    misses = kv_cache_stats["misses"]
+    for D in [0.01, 0.012, 0.01]:  # Only D changes: Same Bessel values
+        model.loglike([D, 70])
+        model.score([D, 70])
+    assert kv_cache_stats["misses"] == misses and kv_cache_stats["hits"] > 0
+    assert kv_cache_stats["bytes"] <= kv_cache_bytes
+    assert kv_cache_stats["bytes"] == sum(v.nbytes for v in kv_cache.values())
+    print("kv cache: %i hits, %i misses, %i bytes" % (kv_cache_stats["hits"], kv_cache_stats["misses"], kv_cache_stats["bytes"]))
+
+
+if __name__ == "__main__":
+    check_params_from_old()
+    check_kv_cache()
@@ -8,7 +8,8 @@ Most quantities are for probabilities per pair
 from statsmodels.base.model import GenericLikelihoodModel
 from scipy.special import kv as kv  # Import Bessel functions of second kind
 from bisect import bisect_left, bisect_right
-import matplotlib.pyplot as plt
+from scipy import sparse
+from copy import copy
 import numpy as np
     
 class MLE_estim_error(GenericLikelihoodModel):
@@ -34,10 +35,20 @@ class MLE_estim_error(GenericLikelihoodModel):
     start_params = []  # List of parameters for the starting array
     error_model = True  # Parameter whether to use error model
     estimates = []  # The last parameter which has been fit
+    bin_counts = []  # Sparse matrix (csr) of number of blocks per observation (rows) and bin of interest (columns)
+    batch_size = 2000  # Max. number of observations whose sharing is calculated at once
+    density_derivs = False  # Whether density_fun gives analytic derivatives (keyword deriv=True)
+    obs_weights = None  # Weight of every observation in the likelihood (e.g. for bootstrap). None: All 1
+    verbose = True  # Whether to print parameters and log likelihood of every evaluation
     
-    def __init__(self, bl_dens_fun, start_params, pw_dist, pw_IBD, pw_nr, error_model=True, **kwds):
+    def __init__(self, bl_dens_fun, start_params, pw_dist, pw_IBD, pw_nr, error_model=True, bin_counts=None,
+                 density_derivs=False, obs_weights=None, **kwds):
         '''Takes the function; start parameters and three important lists as input:
-        List of pw. distances, list of pw. nr and list of pw. IBD-Lists (in cM)'''
+        List of pw. distances, list of pw. nr and list of pw. IBD-Lists (in cM).
+        bin_counts: Already binned blocks (sparse matrix as self.bin_counts); then the IBD-lists are not binned again
+        density_derivs: Whether bl_dens_fun(l, r, params, deriv=True) gives value, gradient and Hessian.
+        Then analytic score and Hessian are used (and BFGS for fitting)
+        obs_weights: Weight of every observation in the log likelihood'''
         exog = np.column_stack((pw_dist, pw_nr))  # Stack the exogenous variables together
         endog = pw_IBD
         super(MLE_estim_error, self).__init__(endog, exog, **kwds)  # Create the full object.
@@ -46,13 +57,36 @@ class MLE_estim_error(GenericLikelihoodModel):
         self.density_fun = bl_dens_fun  # Set the block density function 
         self.start_params = start_params 
         self.error_model = error_model  # Whether to use error model
+        self.density_derivs = density_derivs
+        self.obs_weights = obs_weights
         if self.error_model == True:  # In case required:  
             self.calculate_trans_mat()  # Calculate the Transformation matrix
+        if bin_counts is None:
+            self.calculate_bin_counts()  # Bin the blocks of every observation once
+        else:
+            self.bin_counts = sparse.csr_matrix(bin_counts)
+        
+    def reweighted(self, obs_weights):
+        '''Model on the same data with new observation weights. Shallow copy: Data, bin counts and 
+        transition matrix are shared, nothing is recomputed; self is not changed. So it is cheap and 
+        several of them can be fit at the same time'''
+        model = copy(self)
+        model.obs_weights = np.asarray(obs_weights, dtype=float)
+        return model
+    
+    def masked(self, mask):
+        '''Model that only uses the observations in mask (boolean array) in the likelihood. 
+        As reweighted; the weights of the other observations are 0'''
+        weights = np.asarray(mask, dtype=float)
+        if self.obs_weights is not None:
+            weights = weights * self.obs_weights
+        return self.reweighted(weights)
         
     def loglikeobs(self, params):
         '''Return vector of log likelihoods for every observation. (here pairs of pops)'''
-        for i in range(len(params)):
-            print("Parameter %.0f : %.8f" % (i, params[i]))
+        if self.verbose == True:
+            for i in range(len(params)):
+                print("Parameter %.0f : %.8f" % (i, params[i]))
         C = params[0]  # Absolute Parameter
         sigma = params[1]  # Dispersal parameter
 
@@ -60,20 +94,95 @@ class MLE_estim_error(GenericLikelihoodModel):
         if C <= 0 or sigma <= 0:  # If Parameters do not make sense return infinitely negative likelihood
             return -np.ones(len(self.endog)) * (np.inf)
         
-        ll = [self.pairwise_ll(self.endog[i], self.exog[i, :], params) for i in range(len(self.endog))]
-        print("Total log likelihood: %.4f" % np.sum(ll))
-        return np.array(ll).astype('float')  # Return negative log likelihood
+        ll = self.batch_ll(params)  # Everything in a few array operations. Same as pairwise_ll for every pair
+        if self.verbose == True:
+            print("Total log likelihood: %.4f" % np.sum(ll))
+        return ll
 
     def fit(self, start_params=None, maxiter=10000, maxfun=5000, **kwds):
         # we have one additional parameter and we need to add it for summary
-        if start_params == None:
+        if start_params is None:
             start_params = self.start_params  # Set the starting parameters for the fit
-        fit = super(MLE_estim_error, self).fit(start_params=start_params,
-                                     maxiter=maxiter, maxfun=maxfun,
-                                     **kwds)
+        if self.density_derivs == True and "method" not in kwds:  # Gradient based with the analytic score
+            start_params, opt = self.fit_log_params(start_params, maxiter)
+            # Only to create the results (statsmodels) at the optimum:
+            fit = super(MLE_estim_error, self).fit(start_params=start_params, method="bfgs", maxiter=0,
+                                                   disp=False, warn_convergence=False)
+            fit.mle_retvals["converged"] = opt.success
+            fit.mle_retvals["iterations"] = opt.nit
+        else:
+            fit = super(MLE_estim_error, self).fit(start_params=start_params,
+                                         maxiter=maxiter, maxfun=maxfun,
+                                         **kwds)
         self.estimates = fit.params
         return fit
     
+    def fit_log_params(self, start_params, maxiter=10000):
+        '''BFGS with the analytic score in log C and log sigma (other parameters unchanged);
+        so no step can go to C <= 0 or sigma <= 0, where the likelihood is -inf.
+        The objective is scaled by the log likelihood at the start (otherwise the first steps
+        overshoot far from the boundary); non-finite values make the line search step back.
+        Return optimum (in the original parameters) and the scipy result'''
+        from scipy.optimize import minimize
+        start_params = np.array(start_params, dtype=float)
+        if start_params[0] <= 0 or start_params[1] <= 0:
+            raise ValueError("Start parameters have to be positive: %s" % start_params)
+        
+        def to_params(x):
+            params = np.array(x, dtype=float)
+            params[:2] = np.exp(x[:2])
+            return params
+        
+        scale = max(abs(self.loglike(start_params)), 1.0)
+        if not np.isfinite(scale):
+            raise ValueError("Log likelihood not finite at the start parameters: %s" % start_params)
+        
+        def neg_ll(x):
+            value = -self.loglike(to_params(x)) / scale
+            return value if np.isfinite(value) else np.inf
+        
+        def neg_score(x):
+            params = to_params(x)
+            d_params = np.concatenate((params[:2], np.ones(len(params) - 2)))  # Derivative of params in x
+            return -self.score(params) * d_params / scale
+        
+        x0 = start_params.copy()
+        x0[:2] = np.log(x0[:2])
+        with np.errstate(over="ignore", invalid="ignore", divide="ignore"):  # Far out steps are stepped back
+            opt = minimize(neg_ll, x0, jac=neg_score, method="BFGS", options={"maxiter": maxiter, "gtol": 1e-10})
+        return to_params(opt.x), opt
+    
+    def score(self, params):
+        '''Gradient of the log likelihood. Analytic if density_derivs; otherwise numerical'''
+        if self.density_derivs == True and params[0] > 0 and params[1] > 0:
+            return self.loglike_derivs(params)[0]
+        return super(MLE_estim_error, self).score(params)
+    
+    def hessian(self, params):
+        '''Hessian of the log likelihood. Analytic if density_derivs; otherwise numerical'''
+        if self.density_derivs == True and params[0] > 0 and params[1] > 0:
+            return self.loglike_derivs(params)[1]
+        return super(MLE_estim_error, self).hessian(params)
+    
+    def loglike_derivs(self, params):
+        '''Score and Hessian of the total log likelihood from the analytic density derivatives.
+        ll = sum(c * log(p)) - n * sum(p) for bin counts c and sharing probabilities p'''
+        r, pw_nr = self.exog[:, 0], self.exog[:, 1]
+        score = np.zeros(len(params))
+        hessian = np.zeros((len(params), len(params)))
+        for i in range(0, len(r), self.batch_size):  # In batches to limit memory
+            j = min(i + self.batch_size, len(r))
+            shr_pr, d_shr, dd_shr = self.calculate_full_bin_prob_derivs(r[i:j], params)
+            counts = self.bin_counts[i:j].toarray()
+            w = counts / shr_pr - pw_nr[i:j, None]  # Derivative of ll in p
+            obs_w = 1.0 if self.obs_weights is None else self.obs_weights[i:j, None]
+            w = w * obs_w
+            counts = counts * obs_w
+            score += np.tensordot(d_shr, w, axes=([1, 2], [0, 1]))
+            hessian += np.tensordot(dd_shr, w, axes=([2, 3], [0, 1]))
+            hessian -= np.tensordot(d_shr * (counts / shr_pr ** 2), d_shr, axes=([1, 2], [1, 2]))
+        return score, hessian
+    
     def pairwise_ll(self, l, exog, params):
         '''Log likelihood function for every raw of data (sharing between countries).
         Return log likelihood.'''
@@ -95,6 +204,35 @@ class MLE_estim_error(GenericLikelihoodModel):
         ll = l1 + log_pr_no_shr
         return(ll)    
     
+    def batch_ll(self, params):
+        '''Log likelihood of all observations at once. Uses the bin counts of the observations
+        and the bin sharing probabilities for all distances. Return vector'''
+        r, pw_nr = self.exog[:, 0], self.exog[:, 1]
+        ll = np.zeros(len(r))
+        for i in range(0, len(r), self.batch_size):  # In batches to limit memory
+            j = min(i + self.batch_size, len(r))
+            shr_pr = self.calculate_full_bin_prob_batch(r[i:j], params)[:, self.min_ind:self.max_ind]
+            counts = self.bin_counts[i:j].tocoo()  # Only the bins with blocks
+            l1 = np.bincount(counts.row, weights=counts.data * np.log(shr_pr[counts.row, counts.col]), minlength=j - i)
+            ll[i:j] = l1 - np.sum(shr_pr, axis=1) * pw_nr[i:j]
+        if self.obs_weights is not None:
+            ll = np.where(self.obs_weights != 0, ll * self.obs_weights, 0.0)  # Left out observations count 0; even if ll=-inf
+        return ll
+    
+    def calculate_bin_counts(self):
+        '''Calculates the sparse matrix of the number of blocks per observation and bin of interest.
+        Same binning as in pairwise_ll. Done once; the data does not change during a fit'''
+        bins = self.mid_bins[self.min_ind:self.max_ind + 1] - 0.5 * self.bin_width  # Rel. bin edges
+        nr_bins = self.max_ind - self.min_ind
+        nr_blocks = [len(l) for l in self.endog]
+        rows = np.repeat(np.arange(len(self.endog)), nr_blocks)  # Observation of every block
+        l = np.concatenate([np.asarray(l, dtype=float) for l in self.endog] + [np.zeros(0)])
+        
+        interesting = (l >= bins[0]) * (l <= bins[-1])  # Cut out only blocks of interest
+        rows, l = rows[interesting], l[interesting]
+        cols = (np.searchsorted(bins, l, side='left') - 1) % nr_bins  # As bisect_left; -1 is last bin
+        self.bin_counts = sparse.csr_matrix((np.ones(len(l)), (rows, cols)), shape=(len(self.endog), nr_bins))  # Duplicates are summed
+    
     def create_bins(self):
         '''Creates the bins according to parameters'''
         bins = np.arange(self.min_b, self.max_b, self.bin_width)  # Create the actual bins
@@ -113,27 +251,12 @@ class MLE_estim_error(GenericLikelihoodModel):
         
     def calculate_trans_mat(self):
         '''Calculate the transition matrix from true estimated to
-        observed values for block sharing.'''
-        k = len(self.trans_mat)
-        for i in range(k):  # Iterate over all starting values
-            x = self.mid_bins[i]
-            pr_detect = (1 - censor_prob((x)))  # Probability of detecting block
-            for j in range(0, i):
-                y = self.mid_bins[j]
-                # Down probability conditional on bigger than cut off:
-                trans_pr = prob_down(x) * down_rate(x) * np.exp(-down_rate(x) * (x - y)) / (1 - np.exp(-down_rate(x) * (x - 1)))
-                self.trans_mat[j, i] = pr_detect * trans_pr * self.bin_width 
-                              
-            for j in range(i + 1, k):
-                y = self.mid_bins[j]
-                trans_pr = (1 - prob_down(x)) * up_rate(x) * np.exp(-up_rate(x) * (y - max(x, 1)))     
-                self.trans_mat[j, i] = pr_detect * trans_pr * self.bin_width
-            
-            y = x  # Now do the i,i case
-            trans_pr_d = prob_down(x) * down_rate(x) * np.exp(-down_rate(x) * (x - y)) / (1 - np.exp(-down_rate(x) * (x - 1)))
-            # trans_pr_u = (1 - prob_down(x)) * up_rate(x) * np.exp(-up_rate(x) * (y - max(x, 1)))
-            trans_pr_u = (1 - prob_down(x)) * up_rate(x) * np.exp(-up_rate(x) * (y - x))
-            self.trans_mat[i, i] = pr_detect * 1 / 2.0 * (trans_pr_d + trans_pr_u) * self.bin_width  # Prob of not going anywhere         
+        observed values for block sharing. Broadcast over all bins;
+        the matrix is cached for the bins (min_b, max_b, bin_width)'''
+        key = (self.min_b, self.max_b, self.bin_width)
+        if key not in trans_mat_cache:
+            trans_mat_cache[key] = get_trans_mat(self.mid_bins, self.bin_width)
+        self.trans_mat = trans_mat_cache[key]
         
     def calculate_full_bin_prob(self):
         '''Calculate the full probablities per bin'''
@@ -143,40 +266,89 @@ class MLE_estim_error(GenericLikelihoodModel):
         else:
             self.full_shr_pr = self.theoretical_shr  # Model without any error in detection
     
+    def calculate_full_bin_prob_batch(self, r, params):
+        '''Full probabilities per bin for a vector of distances r.
+        Return matrix: rows distances, columns bins'''
+        theoretical_shr = self.block_shr_density(self.mid_bins[None, :], np.asarray(r, dtype=float)[:, None], params) * self.bin_width
+        if self.error_model == True:
+            return np.dot(theoretical_shr, self.trans_mat.T) + self.fp_rate  # Model with full error
+        else:
+            return theoretical_shr  # Model without any error in detection
+    
+    def calculate_full_bin_prob_derivs(self, r, params):
+        '''Full probabilities per bin of interest for a vector of distances r with their
+        gradient and Hessian in params. The error model is linear; so derivatives are transformed the same way.
+        Return matrix (distances, bins); gradient (params, distances, bins); Hessian (params, params, distances, bins)'''
+        dens, grad, hess = self.block_shr_density(self.mid_bins[None, :], np.asarray(r, dtype=float)[:, None], params, deriv=True)
+        shr = [dens * self.bin_width, grad * self.bin_width, hess * self.bin_width]  # Normalize for bin width
+        if self.error_model == True:
+            shr = [np.dot(t, self.trans_mat.T) for t in shr]
+            shr[0] = shr[0] + self.fp_rate  # False positives do not depend on params
+        return tuple(t[..., self.min_ind:self.max_ind] for t in shr)
+    
     def get_bl_shr_interval(self, interval, r, params=[0, ]):
         '''Return the estimated block-sharing under the model in interval given distance r.
         For this use all the bins intersecting the interval and average.
         Assumes r is array and return array'''
         if params[0] == 0:  # If not parameters given use last ones fit
             params = self.estimates
+        return self.get_bl_shr_tensor([interval, ], r, params)[..., 0]
+    
+    def get_bl_shr_tensor(self, intervals, r, params):
+        '''Estimated block-sharing for every distance in r (array of any shape) and every interval.
+        One density evaluation for all distances; the means over the bins intersecting
+        every interval are taken from the cumulative sums. Return array (r.shape, intervals)'''
+        r = np.asarray(r, dtype=float)
+        full_shr_pr = self.calculate_full_bin_prob_batch(r.ravel(), params)  # Rows distances, columns bins
+        cum_shr = np.column_stack((np.zeros(len(full_shr_pr)), np.cumsum(full_shr_pr, axis=1)))
+        
         # Find the indices of the right ultimate bins:
         bins = self.mid_bins - 0.5 * self.bin_width
-        ind = bisect_right(bins, interval[0])
-        ind1 = bisect_left(bins, interval[1])
-        
-        estims = np.array([0.0 for i in r])
-        for i in range(len(r)):
-            self.calculate_thr_shr(r[i], params)  # Calculate the theoretical sharing
-            self.calculate_full_bin_prob()  # Calculate the bin probability of sharing a block                
-            # Do the numerical "Integral":
-            mean_value = np.mean([self.full_shr_pr[j] for j in range(ind - 1, ind1 + 1)])
-            estims[i] = mean_value * (interval[1] - interval[0]) / self.bin_width  # Normalize
-        return(estims) 
+        estims = np.zeros((len(full_shr_pr), len(intervals)))
+        for k, interval in enumerate(intervals):
+            ind = max(bisect_right(bins, interval[0]) - 1, 0)
+            ind1 = min(bisect_left(bins, interval[1]) + 1, len(bins))
+            mean_value = (cum_shr[:, ind1] - cum_shr[:, ind]) / (ind1 - ind)  # The numerical "Integral"
+            estims[:, k] = mean_value * (interval[1] - interval[0]) / self.bin_width  # Normalize
+        return estims.reshape(r.shape + (len(intervals),))
             
-    def block_shr_density(self, l, r, params):
+    def block_shr_density(self, l, r, params, **kwds):
         '''Returns block sharing density per cM; if l vector return vector
         Uses self.density_fun as function'''
-        return self.density_fun(l, r, params)
+        return self.density_fun(l, r, params, **kwds)
 
 ############# Functions the class uses for calculating errors. From Ralph/Coop 2013.      
 
+trans_mat_cache = {}  # Transition matrices for (min_b, max_b, bin_width). Read only!
+
+def get_trans_mat(mid_bins, bin_width):
+    '''Transition matrix from true (columns) to observed (rows) block length bins.
+    Return read only array'''
+    k = len(mid_bins)
+    x = mid_bins[None, :]  # True length
+    y = mid_bins[:, None]  # Observed length
+    pr_detect = (1 - censor_prob(x))  # Probability of detecting block
+    p_d, d_r, u_r = prob_down(x), down_rate(x), up_rate(x)
+    
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        norm_d = 1 - np.exp(-d_r * (x - 1))  # Down probability conditional on bigger than cut off
+        trans_pr_d = p_d * d_r * np.exp(-d_r * (x - y)) / norm_d
+        trans_pr_u = (1 - p_d) * u_r * np.exp(-u_r * (y - np.maximum(x, 1)))
+        trans_mat = np.where(np.arange(k)[:, None] < np.arange(k)[None, :], trans_pr_d, trans_pr_u)
+        # Prob of not going anywhere (the i,i case):
+        trans_mat[np.diag_indices(k)] = (1 / 2.0 * (p_d * d_r / norm_d + (1 - p_d) * u_r))[0]
+    
+    trans_mat *= pr_detect * bin_width
+    trans_mat.flags.writeable = False
+    return trans_mat
+
 def censor_prob(l):
     '''Probability of being unobserved given true length of x'''
     return 1.0 / (1 + 0.0772355 * (l ** 2) * np.exp(0.5423082 * l))
         
 def prob_down(l):
     '''Probability  the observed block is shorter than the true block'''
-    l1 = max((l - 1, 0))
+    l1 = np.maximum(l - 1, 0)
     return (1 - 1 / (1.0 + 0.5066205 * l1 * np.exp(0.6761991 * l1))) * 0.341945
     
 def up_rate(l):
@@ -188,7 +360,7 @@ def down_rate(l):
     '''parameter for (conditioned) exponential distr'n of observed-true 
     length given true length of x if observed < true
     '''
-    return np.min([12.0, (0.4009342 + 1.0 / (0.18161222 * l))])
+    return np.minimum(12.0, (0.4009342 + 1.0 / (0.18161222 * l)))
 
 def fp_rate(l):
     '''Gives the false positive rate per pair (!). If l vector return vector'''
@@ -222,7 +394,23 @@ def uniform_density(l, r, params):
 
    
 ######################### Some lines to test the code and make some plots
+def check_boundary_start():
+    '''Fit with the analytic score from a start close to the boundary C = 0. Has to end at the same
+    optimum as from the true parameters; with finite estimates and standard errors'''
+    from resampling import simulated_model
+    model = simulated_model(params=[0.01, 70])
+    model.verbose = False
+    fit = model.fit(start_params=[0.01, 70])
+    fit_boundary = model.fit(start_params=[1e-5, 30])
+    print(fit.params, fit_boundary.params)
+    assert np.all(np.isfinite(fit_boundary.params)) and np.all(fit_boundary.params > 0)
+    assert np.allclose(fit_boundary.params, fit.params, rtol=1e-3)
+    assert np.all(np.isfinite(fit_boundary.bse))
+
+
 if __name__ == "__main__":
+    check_boundary_start()
+    import matplotlib.pyplot as plt
     test = MLE_estim_error(dd_density, [0, 0])
     test.calculate_thr_shr(120, [0.0024, 60.0])
     test.calculate_full_bin_prob()
@@ -0,0 +1,122 @@
+'''
+Created on Oct 19, 2026
+Helpers for running jobs over a process pool and keeping their results on disk.
+pool_imap / pool_map run the jobs and always clean up the pool. Results_Store is an
+append-only file of finished results, so interrupted runs can be resumed.
+Used by resampling, likelihood_grid and the DISCSIM parallel runs.
+'''
+
+import os
+import cPickle as pickle
+from multiprocessing import Pool
+
+
+def pool_imap(fun, jobs, processes=None, ordered=True):
+    '''Generator over fun(job) for all jobs, computed over a process pool.
+    ordered=False: In the order the jobs finish. The pool is terminated in any case (also on errors)'''
+    pool = Pool(processes=processes)
+    try:
+        results = pool.imap(fun, jobs) if ordered else pool.imap_unordered(fun, jobs)
+        for result in results:
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def pool_map(fun, jobs, processes=None):
+    '''List of fun(job) for all jobs, computed over a process pool'''
+    return list(pool_imap(fun, jobs, processes))
+
+
+class Results_Store(object):
+    '''Append-only file of pickled (key, result) records.
+    A partly written record at the end (interrupted sweep) is cut away when opened.
+    header: Description of the runs (e.g. kind, number, seed); saved as first record
+    and checked when resuming, so results of different runs are never mixed.
+    path None: Results are only kept in memory'''
+    path = ""
+    header = None
+    results = {}  # Dictionary key: result of all finished runs
+
+    def __init__(self, path, header=None):
+        self.path = path
+        self.header = header
+        self.results = {}
+        stored_header = None
+        if path and os.path.exists(path):
+            stored_header = self.load()
+        if header is not None:
+            self.check_header(stored_header)
+
+    def load(self):
+        '''Load all complete records; cut away incomplete last record. Return the stored header'''
+        good_pos = 0
+        stored_header = None
+        with open(self.path, "rb") as f:
+            while True:
+                try:
+                    key, result = pickle.load(f)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, IndexError, KeyError, AttributeError, TypeError):
+                    break  # Broken last record
+                if key is None:  # Header record
+                    stored_header = result
+                else:
+                    self.results[key] = result
+                good_pos = f.tell()
+
+        if good_pos < os.path.getsize(self.path):
+            print("Cutting away incomplete record of %s" % self.path)
+            with open(self.path, "r+b") as f:
+                f.truncate(good_pos)
+        print("Loaded %i finished runs from %s" % (len(self.results), self.path))
+        return stored_header
+
+    def check_header(self, stored_header):
+        '''Write the header to a new store; compare it to the one of an existing store'''
+        if stored_header is None and len(self.results) == 0:
+            self.append(None, self.header)
+        elif stored_header != self.header:
+            raise ValueError("Results in %s are from other runs: %r (here: %r)" % (self.path, stored_header, self.header))
+
+    def append(self, key, result):
+        '''Append the result of one run'''
+        if self.path:
+            with open(self.path, "ab") as f:
+                pickle.dump((key, result), f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+        if key is not None:
+            self.results[key] = result
+
+    def done(self, key):
+        return key in self.results
+
+
+######################### Some lines to test the code
+def check_store(path="test_store.p"):
+    '''Resume after a broken last record; refuse a store of other runs'''
+    if os.path.exists(path):
+        os.remove(path)
+    store = Results_Store(path, header=("pairs", 3, 2000))
+    store.append(0, [1.0, 2.0])
+    with open(path, "ab") as f:
+        f.write(pickle.dumps((1, [3.0, 4.0]), protocol=pickle.HIGHEST_PROTOCOL)[:-3])  # Interrupted write
+
+    store = Results_Store(path, header=("pairs", 3, 2000))  # Cuts the broken record away
+    store.append(2, [5.0, 6.0])
+    store = Results_Store(path, header=("pairs", 3, 2000))
+    assert sorted(store.results.keys()) == [0, 2]
+    try:
+        Results_Store(path, header=("blocks", 3, 2000))
+        raise AssertionError("Store of other runs was accepted")
+    except ValueError:
+        pass
+    os.remove(path)
+    print("Results_Store okay")
+
+
+if __name__ == "__main__":
+    check_store()
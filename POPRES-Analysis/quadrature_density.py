@@ -0,0 +1,122 @@
+'''
+Created on Oct 19, 2026
+Block sharing density for general population density histories D(t),
+by numerical integration over time t (in generations):
+density(l) = 1/100 * Int [(G - l) * t + 1] * exp(-2lt) * exp(-r^2 / (4 sigma^2 t)) / (2 pi sigma^2 D(t)) dt
+(l and G in Morgan; per cM; with chromosomal edge effects). For D(t) = D t^(-b)
+this is the closed form of mle_analysis (bd_basis). Gauss-Legendre quadrature in log(t);
+the length terms only depend on the bins and are computed once. The integral starts at
+t_min = 1e-8: Cutting at larger t loses the small-t mass that dominates at short distances.
+'''
+
+import numpy as np
+import hashlib
+from collections import OrderedDict
+
+
+def constant_demography(t, params):
+    '''Constant population density. params: D, sigma'''
+    return params[0] * np.ones(len(t))
+
+def power_growth_demography(t, params):
+    '''Population density D t^(-beta) (doomsday: beta=1). params: D, sigma, beta'''
+    return params[0] * t ** (-params[2])
+
+def exp_growth_demography(t, params):
+    '''Exponential growth to the present: D exp(-mu t). params: D, sigma, mu'''
+    return params[0] * np.exp(-params[2] * t)
+
+def stepwise_demography(t, params, breaks):
+    '''Piecewise constant population density. params: D, sigma, D_1, ..., D_k.
+    D for t < breaks[0]; D_i for breaks[i-1] <= t < breaks[i] (breaks in generations, k of them)'''
+    sizes = np.concatenate(([params[0]], params[2:]))
+    return sizes[np.searchsorted(breaks, t, side='right')]
+
+
+class Quadrature_Density(object):
+    '''
+    Callable block sharing density (l, r, params, g) for the population density history demography(t, params).
+    Can be used as density_fun of MLE_estim_error. If gs given: Summed over all chromosomes in gs (diploids).
+    '''
+    demography = 0  # Function of times (vector) and params giving the population density
+    gs = None  # Lengths of all chromosomes (Morgan). None: One chromosome of length g per call
+    nr_nodes = 300  # Number of quadrature nodes
+    t_min, t_max = 1e-8, 1e6  # Range of integration (generations)
+    t = []  # Quadrature nodes (in t)
+    weights = []  # Quadrature weights (in t; including the Jacobian of log(t))
+    l_cache = OrderedDict()  # Length terms for recently used l (LRU)
+    l_cache_size = 8  # Maximum number of cached l arrays
+
+    def __init__(self, demography, gs=None, nr_nodes=300, t_min=1e-8, t_max=1e6):
+        self.demography = demography
+        self.gs = None if gs is None else np.asarray(gs, dtype=float)
+        self.nr_nodes, self.t_min, self.t_max = nr_nodes, t_min, t_max
+        self.l_cache = OrderedDict()  # Own cache for every object
+
+        x, w = np.polynomial.legendre.leggauss(nr_nodes)  # Nodes and weights on [-1, 1]
+        u_min, u_max = np.log(t_min), np.log(t_max)
+        u = (u_max + u_min) / 2.0 + (u_max - u_min) / 2.0 * x
+        self.t = np.exp(u)
+        self.weights = w * (u_max - u_min) / 2.0 * self.t  # dt = t du
+
+    def l_terms(self, l):
+        '''Terms of the integrand only depending on l (Morgan) and t, split by the factor G:
+        A = w t exp(-2lt) and B = w (1 - lt) exp(-2lt); the weights w include the Jacobian t.
+        Shape l.shape + (nodes,). Cached'''
+        key = (l.shape, hashlib.md5(l.tobytes()).hexdigest())
+        if key in self.l_cache:
+            terms = self.l_cache.pop(key)  # Re-inserted below as most recently used
+        else:
+            lt = l[..., None] * self.t
+            base = self.weights * np.exp(-2.0 * lt)
+            terms = (base * self.t, base * (1.0 - lt))
+            if len(self.l_cache) >= self.l_cache_size:
+                self.l_cache.popitem(last=False)  # Remove least recently used
+        self.l_cache[key] = terms
+        return terms
+
+    def r_terms(self, r, params):
+        '''Terms of the integrand depending on r, sigma and the demography. Shape r.shape + (nodes,)'''
+        sigma = params[1]
+        D_t = self.demography(self.t, params)
+        return np.exp(-r[..., None] ** 2 / (4.0 * sigma ** 2 * self.t)) / (2 * np.pi * sigma ** 2 * D_t)
+
+    def __call__(self, l, r, params, g=1.0):
+        '''Block sharing density per cM(!) for l (cM) and r; broadcasts.
+        For l a row (1, bins) and r a column (distances, 1) this is one matrix product'''
+        l, r = np.asarray(l, dtype=float) / 100.0, np.asarray(r, dtype=float)  # Switch to Morgan
+        A, B = self.l_terms(l)
+        if self.gs is not None:  # All chromosomes: Linear in G; so sum G first. Factor four for diploids
+            l_part = 4.0 * (np.sum(self.gs) * A + len(self.gs) * B)
+        else:
+            l_part = g * A + B
+        r_part = self.r_terms(r, params)
+
+        if l.ndim == 2 and r.ndim == 2 and l.shape[0] == 1 and r.shape[1] == 1:  # Grid of distances x bins
+            return np.dot(r_part[:, 0, :], l_part[0].T) / 100.0
+        return np.einsum('...t,...t->...', l_part, r_part) / 100.0  # Factor for density in centi Morgan
+
+
+######################### Some lines to test the code
+def check_closed_forms(tol=1e-10):
+    '''Compare to the closed forms of mle_analysis on a grid of block lengths and distances.
+    Includes short distances; there the small times matter most'''
+    from mle_analysis import uniform_density, dd_density, powergrowth_density
+    l = np.linspace(1, 30, 60)[None, :]
+    r = np.concatenate(([0.1, 1.0], np.linspace(10, 2000, 40)))[:, None]
+    checks = [(constant_demography, uniform_density, [0.5, 70]),
+              (power_growth_demography, dd_density, [0.5, 70, 1.0]),  # Doomsday: beta = 1
+              (power_growth_demography, powergrowth_density, [0.5, 70, 0.7])]
+    for demography, closed_form, params in checks:
+        dens = Quadrature_Density(demography)
+        ratio = dens(l, r, params, 1.5) / closed_form(l, r, params, 1.5)
+        print("%s: Maximum relative error %.2e" % (closed_form.__name__, np.max(np.abs(ratio - 1))))
+        assert np.all(np.abs(ratio - 1) < tol)
+
+        dens = Quadrature_Density(demography, gs=[1.5, 0.7])  # All chromosomes
+        ratio = dens(l, r, params) / (4 * (closed_form(l, r, params, 1.5) + closed_form(l, r, params, 0.7)))
+        assert np.all(np.abs(ratio - 1) < tol)
+
+
+if __name__ == "__main__":
+    check_closed_forms()
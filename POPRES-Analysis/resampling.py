@@ -0,0 +1,117 @@
+'''
+Created on Oct 19, 2026
+Bootstrap and jackknife refits of an MLE_estim_error model over a process pool.
+The base model (binned blocks, transition matrix) is built once in the parent
+process; the workers get it by fork. Every replicate has its own random stream
+(seeded from base_seed and its index), so results do not depend on scheduling.
+Finished fits are appended to a results file as they come in; an interrupted
+run continues with the missing replicates.
+'''
+
+import numpy as np
+from scipy import sparse
+from mle_estim_error import MLE_estim_error
+from process_pool import Results_Store, pool_imap
+
+base_seed = 2000  # Seeds of the replicates are derived from this
+base_model = 0  # Model the replicates are derived from. Set before the pool is started
+start_params = []  # Start parameters of the replicate fits
+row_masks = []  # For jackknife: Boolean mask of the observations kept in every replicate
+
+
+def replicate_seeds(nr, seed=base_seed):
+    '''One independent seed per replicate'''
+    return np.random.RandomState(seed).randint(2 ** 31 - 1, size=nr)
+
+def replicate_model(kind, i, rng):
+    '''Create the model of replicate i.
+    kind: "pairs" resample observations, "blocks" resample blocks within observations,
+    "block_counts" / "block_counts_multinomial" resample the binned blocks,
+    "jackknife" keep the observations of row_masks[i]'''
+    model = base_model
+    dists, nrs = model.exog[:, 0], model.exog[:, 1]
+    if kind == "pairs":  # Multinomial number of copies of every observation, as weights
+        weights = rng.multinomial(len(dists), np.ones(len(dists)) / len(dists)).astype(float)
+        return model.reweighted(weights)
+    elif kind in ("block_counts", "block_counts_multinomial"):
+        return MLE_estim_error(model.density_fun, start_params, dists, model.endog, nrs, error_model=model.error_model,
+                               bin_counts=resample_counts(model.bin_counts, rng, kind == "block_counts_multinomial"),
+                               density_derivs=model.density_derivs)
+    elif kind == "jackknife":  # Shares all data with the base model; only the mask is new
+        return model.masked(row_masks[i])
+    elif kind == "blocks":  # Poisson number of new blocks per observation; then resample within
+        bl_lists = np.empty(len(model.endog), dtype=np.object)
+        for j, b_list in enumerate(model.endog):
+            b_list = np.asarray(b_list)
+            bl_lists[j] = rng.choice(b_list, rng.poisson(len(b_list))) if len(b_list) > 0 else b_list
+        return MLE_estim_error(model.density_fun, start_params, dists, bl_lists, nrs, error_model=model.error_model,
+                               density_derivs=model.density_derivs)
+    else:
+        raise ValueError("Unknown resampling: %s" % kind)
+
+def resample_counts(bin_counts, rng, multinomial=False):
+    '''Resample the blocks of the sparse bin counts directly. Poisson: Every count c becomes Poisson(c);
+    the same distribution as a Poisson number of blocks per observation drawn with replacement from its blocks.
+    Multinomial: The total number of blocks is kept fixed. Only the data array is new'''
+    counts = bin_counts.data
+    if multinomial:
+        new_counts = rng.multinomial(int(np.sum(counts)), counts / np.sum(counts))
+    else:
+        new_counts = rng.poisson(counts)
+    return sparse.csr_matrix((new_counts.astype(float), bin_counts.indices, bin_counts.indptr), shape=bin_counts.shape)
+
+def fit_replicate(job):
+    '''Fit one replicate in a worker process. job: (kind, index, seed)'''
+    kind, i, seed = job
+    rng = np.random.RandomState(seed)
+    model = replicate_model(kind, i, rng)
+    return i, model.fit(start_params=start_params).params
+
+def run_replicates(model, kind, nr, params, save_path=None, processes=None, masks=[], seed=base_seed):
+    '''Fit nr replicates of model in parallel. Return array of estimates (replicates x parameters).
+    params: Start parameters. save_path: File to append the finished fits to; 
+    only resumed if it is from the same kind, number and seed of replicates.
+    masks: Boolean masks of kept observations (only for kind "jackknife")'''
+    global base_model, start_params, row_masks
+    base_model, start_params, row_masks = model, params, masks  # Inherited by the workers
+
+    store = Results_Store(save_path, header=(kind, nr, int(seed)))
+    seeds = replicate_seeds(nr, seed)
+    jobs = [(kind, i, seeds[i]) for i in range(nr) if not store.done(i)]
+    print("Replicates to do: %i" % len(jobs))
+
+    for i, fit_params in pool_imap(fit_replicate, jobs, processes, ordered=False):
+        store.append(i, fit_params)
+        print("Finished replicate %i" % i)
+    return np.array([store.results[i] for i in range(nr)])
+
+
+######################### Some lines to test the code
+def simulated_model(params=[0.01, 70], nr_pairs=30, seed=5):
+    '''MLE_estim_error with blocks simulated from the constant model (blocks at the bin centers)'''
+    from functools import partial
+    from mle_analysis import uniform_density
+    rng = np.random.RandomState(seed)
+    density = partial(uniform_density, g=35.374)
+    dists, nrs = np.linspace(100, 2000, nr_pairs), np.ones(nr_pairs) * 2000
+    blocks = np.empty(nr_pairs, dtype=np.object)
+    blocks[:] = [[] for _ in range(nr_pairs)]
+    model = MLE_estim_error(density, params, dists, blocks, nrs, density_derivs=True)
+    counts = rng.poisson(model.calculate_full_bin_prob_batch(dists, params) * nrs[:, None])
+    for i in range(nr_pairs):
+        blocks[i] = np.repeat(model.mid_bins, counts[i])
+    return MLE_estim_error(density, params, dists, blocks, nrs, density_derivs=True)
+
+def check_bootstrap(nr=2, processes=2):
+    '''Fit simulated data and run real bootstrap replicates starting from the fitted estimates'''
+    model = simulated_model()
+    model.verbose = False
+    estimates = model.fit().params  # An array; as MLE_analyse.estimates
+    for kind in ("pairs", "block_counts"):
+        res = run_replicates(model, kind, nr, estimates, processes=processes)
+        print(res)
+        assert res.shape == (nr, len(estimates)) and np.all(np.isfinite(res))
+
+
+if __name__ == "__main__":
+    check_bootstrap()